@@ -0,0 +1,204 @@
+"""asyncio counterparts of the icommands session classes, for ASGI deployments.
+
+AsyncSession offers the same run/run_safe/admin/stream surface as icommands.Session, but its
+methods are coroutines driving asyncio subprocesses, so waiting on iRODS doesn't hold a thread.
+It uses the same session directory layout, so an existing Session's environment and
+authentication files can be reused with AsyncSession.from_session().
+
+This module requires Python 3.5+ and is not imported by the rest of the package.
+"""
+
+import asyncio
+import os
+
+from django_irods import icommands
+from django_irods.icommands import Session, SessionException, SessionTimeoutException, StreamLimitException, _budget
+
+
+class AsyncStreamingProcess(object):
+    """The asyncio version of icommands.StreamingProcess: an async iterator over a child's stdout
+    that drains stderr concurrently, raises SessionException on a non-zero exit, and kills the
+    child when closed early or once it outlives its time budget.
+    """
+    CHUNK_SIZE = 65536
+    STDERR_LIMIT = 65536
+
+    def __init__(self, proc, slot=None, gated=None, timeout=None):
+        self.proc = proc
+        self._slot = slot
+        self._gated = gated  # (HostGate, token) to report the outcome to
+        self.timeout = timeout
+        self.fired = False
+        self._timer = asyncio.get_event_loop().call_later(timeout, self._expire) if timeout is not None else None
+        self._stderr = []
+        self._drain = asyncio.ensure_future(self._drain_stderr())
+
+    def _expire(self):
+        if self.proc.returncode is None:
+            self.fired = True
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass  # exited in the meantime
+
+    async def _drain_stderr(self):
+        kept = 0
+        while True:
+            chunk = await self.proc.stderr.read(4096)
+            if not chunk:
+                break
+            if kept < self.STDERR_LIMIT:
+                self._stderr.append(chunk)
+                kept += len(chunk)
+
+    def _release(self, failed=False):
+        if self._timer is not None:
+            self._timer.cancel()
+        slot, self._slot = self._slot, None
+        if slot is not None:
+            slot.release()
+        gated, self._gated = self._gated, None
+        if gated is not None:
+            gated[0].release(gated[1], failed)
+
+    @property
+    def stderr(self):
+        return b''.join(self._stderr)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.proc.stdout.read(self.CHUNK_SIZE)
+        if data:
+            return data
+        returncode = await self.proc.wait()
+        await self._drain
+        self._release(self.fired or bool(returncode and any(e.encode() in self.stderr for e in icommands.OVERLOAD_ERRORS)))
+        if self.fired:
+            raise SessionTimeoutException(self.timeout, b'', self.stderr)
+        if returncode:
+            raise SessionException(returncode, b'', self.stderr)
+        raise StopAsyncIteration
+
+    def close(self):
+        # called synchronously by the response when the client goes away; the event loop's child
+        # watcher reaps the killed process
+        if self.proc.returncode is None:
+            self.proc.kill()
+        self._drain.cancel()
+        self._release()
+
+
+class AsyncSession(Session):
+    """A Session whose commands are coroutines.  Environment setup (create_environment,
+    delete_environment) is inherited unchanged; it only writes small local files.
+    """
+
+    @classmethod
+    def from_session(cls, session):
+        """Share the environment and credentials of an already initialized Session."""
+        shared = cls(session.root, session.icommands_path, session.session_id)
+        shared.host_key = session.host_key
+        shared.pool = session.pool
+        return shared
+
+    async def _spawn(self, argList, stdin=None):
+        return await asyncio.create_subprocess_exec(
+            *argList,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self._environ()
+        )
+
+    async def _communicate(self, argList, data=None, timeout=None):
+        """Runs a command to completion within its time budget and returns tuple (returncode, stdout,
+        stderr), failing over to the next provider like Session._communicate.
+        """
+        tried = set()
+        while True:
+            returncode, stdout, stderr = await self._communicate_once(argList, data, timeout, tried)
+            if returncode and any(e.encode() in stderr for e in icommands.UNREACHABLE_ERRORS) and self._fail_over(tried):
+                continue
+            return returncode, stdout, stderr
+
+    async def _communicate_once(self, argList, data, timeout, tried):
+        # thread-local deadlines don't follow tasks around the event loop, so only
+        # per-command timeouts apply here; wrap calls in asyncio.wait_for for a deadline
+        budget = _budget(os.path.basename(argList[0]), timeout, use_deadline=False)
+        # admission waits would block the event loop, so only the circuit breaker applies here
+        gate, token = self._pass_breaker(tried, lambda gate: gate.enter(timed=True))
+        failed = False
+        try:
+            proc = await self._spawn(argList, asyncio.subprocess.PIPE if data else None)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(input=data), budget)
+            except asyncio.TimeoutError:
+                failed = True
+                proc.kill()
+                await proc.wait()
+                raise SessionTimeoutException(budget)
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+            failed = bool(proc.returncode and any(e.encode() in stderr for e in icommands.OVERLOAD_ERRORS))
+        finally:
+            if gate:
+                gate.release(token, failed)
+        return proc.returncode, stdout, stderr
+
+    async def run(self, icommand, data=None, *args, timeout=None):
+        """Runs an icommand with optional argument list and
+        returns tuple (stdout, stderr) from subprocess execution.
+        """
+        returncode, stdout, stderr = await self._communicate(self._argv(icommand, args), data, timeout)
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
+        return stdout, stderr
+
+    async def run_safe(self, icommand, data=None, *args):
+        """Starts an icommand and returns the asyncio Process without waiting for it, on a provider
+        whose breaker is closed, as Session.run_safe does.
+        """
+        self._pass_breaker(set(), lambda gate: gate.check())
+        return await self._start(icommand, data, args)
+
+    async def _start(self, icommand, data, args):
+        proc = await self._spawn(self._argv(icommand, args), asyncio.subprocess.PIPE if data else None)
+        if data:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        return proc
+
+    async def stream(self, icommand, data=None, *args):
+        """Starts an icommand whose stdout is to be streamed and returns it as an
+        AsyncStreamingProcess.  Shares the IRODS_MAX_STREAMING_CHILDREN cap with Session.stream, and
+        like it is killed once it outlives the icommand's own time budget.
+        """
+        budget = _budget(icommand, use_deadline=False)
+        gate, token = self._pass_breaker(set(), lambda gate: gate.enter())
+        slots = icommands._streaming_slots
+        if slots is not None and not slots.acquire(False):
+            if gate:
+                gate.release(token, False)
+            raise StreamLimitException(icommands.MAX_STREAMING_CHILDREN)
+        try:
+            proc = await self._start(icommand, data, args)
+        except:
+            if slots is not None:
+                slots.release()
+            if gate:
+                gate.release(token, False)
+            raise
+        return AsyncStreamingProcess(proc, slots, (gate, token) if gate else None, budget)
+
+    async def admin(self, *args, timeout=None):
+        """Runs the iadmin icommand with optional argument list and
+        returns tuple (stdout, stderr) from subprocess execution.
+        """
+        returncode, stdout, stderr = await self._communicate(self._argv('iadmin', args), timeout=timeout)
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
+        return stdout, stderr
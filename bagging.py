@@ -0,0 +1,289 @@
+"""
+Incremental construction of bag zip files.
+
+IrodsStorage.zipup normally runs ``ibun -cDzip`` over the whole resource collection, so editing a
+single metadata file rebuilds (and recompresses) every member of the bag.  When IRODS_BAG_CACHE_DIR
+is set, zipup hands the work to IncrementalZip instead.  Each build leaves the zip it produced in
+the cache directory together with a member manifest recording the size, checksum and modification time
+of every data object that went into it, and the empty collections, which get directory entries as with ibun.  The next build copies the already-compressed bytes of unchanged members
+straight out of the cached zip and only fetches and deflates the members whose fingerprint changed.
+If no member changed at all, nothing is rebuilt or uploaded.
+
+iRODS data objects cannot be rewritten in place through the icommands, so the finished zip is still
+uploaded in full; fetching and compression are what scale with the size of the change.  The cache
+directory should be shared between the workers that build bags, otherwise a worker without a cached
+copy falls back to fetching every member.
+
+The bagit rule that generates the bag's files can also be queued on the server as a delayed rule
+(IrodsStorage.runBagitRule(..., delayed=True)), which returns a BagBuild handle instead of blocking.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import posixpath
+import re
+import struct
+import time
+import zipfile
+from tempfile import NamedTemporaryFile
+from uuid import uuid4
+
+from django.conf import settings
+
+from django_irods.query import Query
+
+CHUNK_SIZE = 1024 * 1024
+_ZIP64_EXTRA_ID = 0x0001
+
+
+def _strip_zip64_extra(extra):
+    """Remove the ZIP64 extra field, which zipfile regenerates itself when the entry is written."""
+    kept = []
+    i = 0
+    while i + 4 <= len(extra):
+        tag, length = struct.unpack('<HH', extra[i:i + 4])
+        if tag != _ZIP64_EXTRA_ID:
+            kept.append(extra[i:i + 4 + length])
+        i += 4 + length
+    return b''.join(kept)
+
+
+def copy_member(source, dest, info):
+    """
+    Copy one entry from an open zip file into another without decompressing it.
+    :param source: a ZipFile opened for reading
+    :param dest: a ZipFile opened for writing
+    :param info: the ZipInfo of the entry in source
+    :return: None
+    """
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    info = copy.copy(info)
+    info.flag_bits &= ~0x08  # sizes and CRC are known up front, so no trailing data descriptor
+    info.extra = _strip_zip64_extra(info.extra)
+    info.header_offset = dest.fp.tell()
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    dest.fp.write(info.FileHeader(zip64))
+
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.fp.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipfile("Truncated member {name} in cached bag".format(name=info.filename))
+        dest.fp.write(chunk)
+        remaining -= len(chunk)
+
+    dest.filelist.append(info)
+    dest.NameToInfo[info.filename] = info
+    dest._didModify = True
+    dest.start_dir = dest.fp.tell()
+
+
+class IncrementalZip(object):
+    def __init__(self, storage, cache_dir):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass  # another worker created it first
+
+    def _cache_paths(self, out_name):
+        key = hashlib.sha1(out_name.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.zip', base + '.json'
+
+    def _previous_manifest(self, zip_path, manifest_path):
+        """Load the manifest of the last build, or None if it doesn't describe the cached zip."""
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('zip_size') != os.path.getsize(zip_path) or 'members' not in manifest:
+                return None
+            return manifest
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _fetch(self, zf, path, arcname):
+        tmp = NamedTemporaryFile(dir=self.cache_dir)
+        try:
+            self.storage.session.run("iget", None, '-f', path, tmp.name)
+            zf.write(tmp.name, arcname)
+        finally:
+            tmp.close()
+
+    def build(self, in_name, out_name):
+        """
+        Bring the zip of a collection up to date, reusing unchanged members of the last build.
+        :param in_name: the collection path to generate the zip from
+        :param out_name: the output zip file name in iRODS
+        :return: True if a new zip was uploaded, False if the existing one was already current
+        """
+        members = self.storage.collection_members(in_name)
+        empty = self.storage.empty_collections(in_name, members)
+        zip_path, manifest_path = self._cache_paths(out_name)
+        manifest = self._previous_manifest(zip_path, manifest_path)
+        previous = manifest['members'] if manifest is not None else None
+
+        if previous == members and manifest.get('empty') == empty and self.storage.exists(out_name):
+            return False
+
+        parent = posixpath.dirname(self.storage.absolute_path(in_name).rstrip('/'))
+        old = zipfile.ZipFile(zip_path) if previous is not None else None
+        with NamedTemporaryFile(dir=self.cache_dir, suffix='.zip', delete=False) as f:
+            tmp_zip = f.name
+        try:
+            new = zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            try:
+                for path in sorted(members):
+                    arcname = posixpath.relpath(path, parent)
+                    if old is not None and previous.get(path) == members[path] and arcname in old.NameToInfo:
+                        copy_member(old, new, old.getinfo(arcname))
+                    else:
+                        self._fetch(new, path, arcname)
+                for coll in empty:
+                    entry = zipfile.ZipInfo(posixpath.relpath(coll, parent) + '/', time.localtime()[:6])
+                    entry.external_attr = (0o40755 << 16) | 0x10  # a directory, for unzip
+                    new.writestr(entry, b'')
+            finally:
+                new.close()
+                if old is not None:
+                    old.close()
+
+            try:
+                self.storage.session.run("iput", None, '-f', tmp_zip, out_name)
+            except:
+                self.storage.session.run("iput", None, '-f', tmp_zip, out_name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
+
+            os.rename(tmp_zip, zip_path)
+            with NamedTemporaryFile('w', dir=self.cache_dir, suffix='.json', delete=False) as f:
+                json.dump({'zip_size': os.path.getsize(zip_path), 'members': members, 'empty': empty}, f)
+            os.rename(f.name, manifest_path)
+        finally:
+            if os.path.exists(tmp_zip):
+                os.unlink(tmp_zip)
+        return True
+
+
+# how long a bag build may hold its lock, and how often a caller waiting on another build checks on it
+BUILD_LOCK_TIMEOUT = getattr(settings, 'IRODS_BAG_LOCK_TIMEOUT', 3600)
+BUILD_LOCK_POLL = 0.5
+
+
+def rebuild_bag(istorage, res_id, stream_bag=False, wait=True):
+    """
+    Regenerate a resource's bag and clear its bag_modified flag.  Only one build of a bag runs at a time across
+    the processes sharing the IRODS_BAG_LOCK_CACHE Django cache, which must therefore be one every web and worker
+    process reaches (memcached, redis, the database), not a per-process local-memory cache.  A caller that finds
+    a build already running doesn't start another.
+    :param istorage: the IrodsStorage holding the resource collection
+    :param res_id: the resource id, which names its collection
+    :param stream_bag: only regenerate the bagit files, for bags that are zipped as they are downloaded
+    :param wait: when a build is already running, wait for it to finish (at most IRODS_BAG_LOCK_TIMEOUT seconds)
+        rather than return at once
+    :return: True if this call built the bag, False if another build was running
+    """
+    from django.core.cache import caches
+    cache = caches[getattr(settings, 'IRODS_BAG_LOCK_CACHE', 'default')]
+    lock = 'irods:bag-build:{res_id}'.format(res_id=res_id)
+    if not cache.add(lock, 1, BUILD_LOCK_TIMEOUT):
+        give_up = time.time() + BUILD_LOCK_TIMEOUT
+        while wait and cache.get(lock) is not None and time.time() < give_up:
+            time.sleep(BUILD_LOCK_POLL)
+        return False
+    try:
+        _rebuild_bag(istorage, res_id, stream_bag)
+    finally:
+        cache.delete(lock)
+    return True
+
+
+def _rebuild_bag(istorage, res_id, stream_bag):
+    if stream_bag:
+        # only the bagit files need regenerating, the zip itself is never stored
+        istorage.runBagitRule(
+            getattr(settings, 'IRODS_BAGIT_RULE', 'hydroshare/irods/ruleGenerateBagIt_HS.r'),
+            "*BAGITDATA='{path}'".format(path=res_id),
+            "*DESTRESC='{def_res}'".format(def_res=istorage.environment.def_res)
+        )
+    else:
+        from hs_core.hydroshare.hs_bagit import create_bag_by_irods
+        create_bag_by_irods(res_id, istorage)
+    # needs to check whether res_id collection exists before setting AVU on it to accommodate the case
+    # where the very same resource gets deleted while its bag is being built
+    if istorage.exists(res_id):
+        istorage.setAVU(res_id, 'bag_modified', "false")
+
+
+# AVU in which a delayed bagit rule records the token of the last build it completed
+BUILD_MARKER = 'bag_build'
+
+_DELAYED_EPILOGUE = """
+        msiString2KeyValPair("{marker}=" ++ *BAGTOKEN ++ ":done", *bagBuildKvp);
+        msiSetKeyValuePairsToObj(*bagBuildKvp, *BAGCOLL, "-C");
+    }}
+}}"""
+
+
+def delayed_rule(text, marker=BUILD_MARKER):
+    """
+    Rewrite the text of a rule file so that its first rule is queued as a delayed rule on the server,
+    and records completion by setting ``marker`` to "<token>:done" on the collection.  The
+    rewritten rule takes two extra inputs: *BAGCOLL, the absolute collection path, and *BAGTOKEN.
+    """
+    start = text.index('{')
+    depth = 0
+    for end in range(start, len(text)):
+        if text[end] == '{':
+            depth += 1
+        elif text[end] == '}':
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        raise ValueError("Unbalanced braces in rule file")
+
+    rest = re.sub(r'(?m)^(INPUT\s+.*?)\s*$', r'\1, *BAGCOLL="", *BAGTOKEN=""', text[end + 1:], count=1)
+    return (text[:start] + '{\n    delay("<PLUSET>1s</PLUSET>") {' + text[start + 1:end]
+            + _DELAYED_EPILOGUE.format(marker=marker) + rest)
+
+
+class BagBuild(object):
+    """
+    Handle on a bagit rule queued on the iRODS server.  The build is done once the collection's
+    bag_build AVU carries this build's token; poll with done() or wait(), or hand the handle to the
+    wait_for_bag Celery task to run a callback (or join a chord) on completion.
+    """
+    def __init__(self, session, collection, token=None):
+        self.session = session
+        self.collection = collection
+        self.token = token or uuid4().hex
+
+    def done(self):
+        rows = Query(self.session, 'META_COLL_ATTR_VALUE') \
+            .filter('COLL_NAME', '=', self.collection) \
+            .avu(BUILD_MARKER).all()
+        return any(row.meta_coll_attr_value == self.token + ':done' for row in rows)
+
+    def wait(self, timeout=None, interval=5):
+        """Block until the build is done; returns False if timeout seconds pass first."""
+        give_up = time.time() + timeout if timeout is not None else None
+        while not self.done():
+            if give_up is not None and time.time() >= give_up:
+                return False
+            time.sleep(interval)
+        return True
+
+    def signature(self, environment=None, callback=None):
+        """A Celery signature of the wait_for_bag task, which completes when this build does."""
+        from django_irods.tasks import WaitForBag
+        return WaitForBag().s(environment, self.collection, self.token, callback)
+
+    def on_complete(self, callback, environment=None):
+        """Call a Celery subtask with the collection name once the build has completed."""
+        return self.signature(environment, callback).delay()
@@ -0,0 +1,173 @@
+"""
+On-the-fly gzip compression of downloads.
+
+Large CSV, JSON and text data objects typically shrink 5-10x, so when the client sends
+``Accept-Encoding: gzip``, downloads of objects whose MIME type is in IRODS_COMPRESS_TYPES (a type, or
+a prefix ending in '/') and which are at least IRODS_COMPRESS_MIN_SIZE bytes are compressed as they
+stream from iget, at IRODS_COMPRESS_LEVEL.  Such responses carry no Content-Length, since the
+compressed size isn't known until the end.
+
+With IRODS_COMPRESS_CACHE_DIR set, the compressed variant is also written to a local file as it
+streams, and later requests for the same version of the object (same path, size, checksum and modification
+time) are served from that file, with a Content-Length and without running iget at all.  Variants of
+objects that have since changed are never served again; prune the directory by age, e.g. with tmpreaper.
+"""
+
+import errno
+import hashlib
+import os
+import posixpath
+import tempfile
+import zlib
+
+from django.conf import settings
+
+from django_irods.query import Query
+
+COMPRESS_TYPES = getattr(settings, 'IRODS_COMPRESS_TYPES', (
+    'text/', 'application/json', 'application/xml', 'application/javascript', 'application/x-netcdf-cdl',
+))
+MIN_SIZE = getattr(settings, 'IRODS_COMPRESS_MIN_SIZE', 256 * 1024)
+LEVEL = getattr(settings, 'IRODS_COMPRESS_LEVEL', 6)
+BLOCK_SIZE = getattr(settings, 'IRODS_STREAM_BLOCK_SIZE', 1024 * 1024)
+
+
+def accepts_gzip(request):
+    """Whether the client's Accept-Encoding allows a gzip response, honouring q=0."""
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    weights = {}
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        coding = parts[0].lower()
+        if not coding:
+            continue
+        weight = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        weights[coding] = weight
+    if 'gzip' in weights:
+        return weights['gzip'] > 0
+    return weights.get('*', 0) > 0
+
+
+def compressible(content_type, size):
+    """Whether a download of this type and size is worth compressing."""
+    if size < MIN_SIZE:
+        return False
+    for allowed in COMPRESS_TYPES:
+        if content_type == allowed or (allowed.endswith('/') and content_type.startswith(allowed)):
+            return True
+    return False
+
+
+def variant_key(session, path, size):
+    """
+    Identify one version of a data object, by absolute path, size, and the modification time (to the second) and
+    checksum from the catalog.  ils -l only gives the time to the minute, which misses same-size edits within
+    a minute.
+    :return: the key, or None if the object isn't in the catalog
+    """
+    query = Query(session, 'DATA_MODIFY_TIME', 'DATA_CHECKSUM') \
+        .filter('COLL_NAME', '=', posixpath.dirname(path)) \
+        .filter('DATA_NAME', '=', posixpath.basename(path))
+    versions = sorted(set(('%s' % (row.data_modify_time,), row.data_checksum or '') for row in query))
+    if not versions:
+        return None
+    # replicas of one version can differ slightly in modify time; the newest stands for all of them
+    modified, checksum = versions[-1]
+    return hashlib.sha1(u'{0}\0{1}\0{2}\0{3}'.format(path, size, modified, checksum).encode('utf-8')).hexdigest()
+
+
+class VariantCache(object):
+    """Compressed variants of data objects, kept as local files named by variant_key()."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.gz')
+
+    def get(self, key):
+        """:return: the file holding a cached variant, or None"""
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def writer(self, key):
+        """:return: an open temporary file to write a variant into, for commit() or abandon()"""
+        directory = os.path.dirname(self.path(key))
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        return open(temp, 'wb')
+
+    def commit(self, key, f):
+        f.close()
+        os.rename(f.name, self.path(key))
+
+    def abandon(self, f):
+        f.close()
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+
+
+def variant_cache():
+    """The VariantCache, or None if IRODS_COMPRESS_CACHE_DIR isn't set."""
+    directory = getattr(settings, 'IRODS_COMPRESS_CACHE_DIR', None)
+    return VariantCache(directory) if directory else None
+
+
+class GzipStream(object):
+    """
+    Streaming response content gzipping a file-like source, such as a StreamingProcess, as it is read.
+    The source is closed with the response.  If a cache is given, the compressed bytes are written to it
+    too, and the variant is only committed once the whole source has been read without error.
+    """
+    def __init__(self, source, level=LEVEL, block_size=BLOCK_SIZE, cache=None, key=None):
+        self.source = source
+        self.block_size = block_size
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.cache = cache
+        self.key = key
+        self._variant = None
+
+    def _write(self, data):
+        if self._variant is not None and data:
+            self._variant.write(data)
+        return data
+
+    def __iter__(self):
+        if self.cache is not None:
+            try:
+                self._variant = self.cache.writer(self.key)
+            except (IOError, OSError):
+                self._variant = None  # the download matters more than the cache
+        while True:
+            chunk = self.source.read(self.block_size)
+            if not chunk:
+                break
+            data = self._write(self.compressor.compress(chunk))
+            if data:
+                yield data
+        yield self._write(self.compressor.flush())
+        if self._variant is not None:
+            variant, self._variant = self._variant, None
+            try:
+                self.cache.commit(self.key, variant)
+            except (IOError, OSError):
+                self.cache.abandon(variant)
+
+    def close(self):
+        if self._variant is not None:
+            variant, self._variant = self._variant, None
+            self.cache.abandon(variant)
+        self.source.close()
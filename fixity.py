@@ -0,0 +1,217 @@
+"""
+Fixity audits: verify the registered checksums of every data object under a collection.
+
+The objects are enumerated with a streamed GenQuery in DATA_ID order and handed to a bounded pool of
+worker threads, each running ``ichksum -K`` (which has the server recompute the checksum and compare it
+with the one in the catalog).  Progress is checkpointed to a JSON file as a low-water mark: the highest
+DATA_ID below which every object has been verified, together with the counts and findings so far.  An
+audit started with the same checkpoint file resumes after that mark, so an audit interrupted by a
+maintenance window closing (or a Celery time limit) picks up where it left off.  Only a hard kill
+between checkpoints can make a resumed audit count a few objects twice.
+
+    audit = FixityAudit(session, '/hydroZone/home/proxy', '/var/lib/irods/audit.json', workers=8)
+    report = audit.run()
+
+Objects without a registered checksum are counted as unregistered rather than checksummed, since
+computing and registering one is a different job from verifying it.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from tempfile import NamedTemporaryFile
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from django.conf import settings
+
+from django_irods.icommands import SessionException
+from django_irods.query import Query
+
+WORKERS = getattr(settings, 'IRODS_FIXITY_WORKERS', 4)
+CHECKPOINT_INTERVAL = getattr(settings, 'IRODS_FIXITY_CHECKPOINT_INTERVAL', 30)
+PAGE_SIZE = getattr(settings, 'IRODS_FIXITY_PAGE_SIZE', 10000)
+
+_MISMATCH_ERRORS = ('USER_CHKSUM_MISMATCH', 'CHKSUM_MISMATCH')
+_DONE = object()
+
+
+class FixityAudit(object):
+    def __init__(self, session, collection, checkpoint_path=None, workers=WORKERS, all_replicas=False):
+        """
+        :param session: the icommands Session to run the audit in
+        :param collection: the absolute path of the collection to audit, recursively
+        :param checkpoint_path: a local file to record progress in and resume from; None to not checkpoint
+        :param workers: the number of ichksum commands to run at once
+        :param all_replicas: verify every replica (ichksum -a) rather than one
+        """
+        self.session = session
+        self.collection = collection.rstrip('/') or '/'
+        self.checkpoint_path = checkpoint_path
+        self.workers = max(1, workers)
+        self.all_replicas = all_replicas
+
+        self._lock = threading.Lock()
+        self._pending = deque()   # DATA_IDs handed out, in enumeration order
+        self._finished = set()    # finished DATA_IDs not yet folded into the low-water mark
+        self.state = self._load()
+
+    def _fresh_state(self):
+        return {
+            'collection': self.collection,
+            'last_id': None,
+            'verified': 0,
+            'bytes': 0,
+            'unregistered': 0,
+            'mismatches': [],
+            'errors': [],
+            'elapsed': 0.0,
+            'complete': False,
+        }
+
+    def _load(self):
+        if self.checkpoint_path:
+            try:
+                with open(self.checkpoint_path) as f:
+                    state = json.load(f)
+                if state.get('collection') == self.collection and not state.get('complete'):
+                    return state
+            except (IOError, OSError, ValueError):
+                pass
+        return self._fresh_state()
+
+    def _checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        with self._lock:
+            text = json.dumps(self.state)
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        with NamedTemporaryFile('w', dir=directory, suffix='.json', delete=False) as f:
+            f.write(text)
+        os.rename(f.name, self.checkpoint_path)
+
+    def objects(self):
+        """
+        Data objects still to verify, one row per object (not per replica), in DATA_ID order.  They are fetched
+        a page at a time, so no single iquest has to outlive its time budget.
+        """
+        prefix = self.collection.rstrip('/') + '/'
+        last = self.state['last_id']
+        while True:
+            query = Query(self.session, 'DATA_ID', 'COLL_NAME', 'DATA_NAME', 'DATA_SIZE', 'DATA_CHECKSUM') \
+                .filter('COLL_NAME', 'like', self.collection + '%') \
+                .order_by('DATA_ID') \
+                .after('DATA_ID', last) \
+                .limit(PAGE_SIZE)
+            rows = 0
+            for row in query:
+                rows += 1
+                if row.data_id == last:
+                    continue  # another replica
+                last = row.data_id
+                # 'like' also matches siblings sharing the collection's name as a prefix
+                if row.coll_name == self.collection or row.coll_name.startswith(prefix):
+                    yield row
+            if rows < PAGE_SIZE:
+                return
+
+    def verify(self, row):
+        """
+        Verify one data object.
+        :return: None if its checksum matched, otherwise the error reported by ichksum
+        """
+        path = row.coll_name.rstrip('/') + '/' + row.data_name
+        options = ('-K', '-a') if self.all_replicas else ('-K',)
+        try:
+            self.session.run('ichksum', None, *(options + (path,)))
+        except SessionException as e:
+            return e.stderr.strip() or e.stdout.strip() or 'exit code {0}'.format(e.exitcode)
+        return None
+
+    def _settle(self, row, error):
+        path = row.coll_name.rstrip('/') + '/' + row.data_name
+        with self._lock:
+            if error is None:
+                self.state['verified'] += 1
+                self.state['bytes'] += row.data_size or 0
+            elif any(marker in error for marker in _MISMATCH_ERRORS):
+                self.state['mismatches'].append({'path': path, 'checksum': row.data_checksum, 'error': error})
+            else:
+                self.state['errors'].append({'path': path, 'error': error})
+            self._advance(row.data_id)
+
+    def _advance(self, data_id):
+        """Mark an object finished and move the low-water mark past every finished object; call with the lock held."""
+        self._finished.add(data_id)
+        while self._pending and self._pending[0] in self._finished:
+            self._finished.discard(self._pending[0])
+            self.state['last_id'] = self._pending.popleft()
+
+    def _work(self, queue):
+        while True:
+            row = queue.get()
+            if row is _DONE:
+                return
+            try:
+                error = self.verify(row)
+            except Exception as e:
+                error = '{0}: {1}'.format(type(e).__name__, e)
+            self._settle(row, error)
+
+    def run(self):
+        """
+        Audit the collection, resuming from the checkpoint if there is one.
+        :return: the report (see report())
+        """
+        queue = Queue(self.workers * 2)
+        threads = [threading.Thread(target=self._work, args=(queue,)) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        started = time.time()
+        elapsed = self.state['elapsed']
+        last_checkpoint = started
+        try:
+            for row in self.objects():
+                with self._lock:
+                    self._pending.append(row.data_id)
+                if not row.data_checksum:
+                    with self._lock:
+                        self.state['unregistered'] += 1
+                        self._advance(row.data_id)
+                else:
+                    queue.put(row)
+                if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    self.state['elapsed'] = elapsed + time.time() - started
+                    self._checkpoint()
+                    last_checkpoint = time.time()
+            complete = True
+        except BaseException:
+            complete = False
+            raise
+        finally:
+            for _ in threads:
+                queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+            self.state['elapsed'] = elapsed + time.time() - started
+            self.state['complete'] = complete
+            self._checkpoint()
+        return self.report()
+
+    def report(self):
+        """
+        :return: dict with the counts of verified and unregistered objects, the mismatches and other errors found
+            (each a dict with the path and error), the bytes verified and the throughput in objects and bytes per
+            second, across every run of the audit
+        """
+        state = dict(self.state)
+        elapsed = state['elapsed'] or 0.0
+        state['objects_per_second'] = state['verified'] / elapsed if elapsed else 0.0
+        state['bytes_per_second'] = state['bytes'] / elapsed if elapsed else 0.0
+        return state
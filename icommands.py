@@ -1,13 +1,27 @@
 """Originally written by Antoine deTorcy"""
 
 import os
+import json
+import random
 import shutil
+import socket
 import subprocess
 import textwrap
-from cStringIO import StringIO
+import threading
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3, where only async_icommands is expected to be used
+    from io import BytesIO as StringIO
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
 from django.conf import settings
 from collections import namedtuple
 
+from django_irods import tracing
+
 class SessionException(Exception):
     def __init__(self, exitcode, stdout, stderr):
         super(SessionException, self).__init__(self, "Error processing IRODS request: {exitcode}. stderr follows:\n\n{stderr}".format(
@@ -17,10 +31,434 @@ class SessionException(Exception):
         self.stderr = stderr
         self.exitcode = exitcode
 
+class StreamLimitException(SessionException):
+    def __init__(self, limit):
+        super(StreamLimitException, self).__init__(-1, '', "Too many streaming icommands in this process (limit {limit})".format(limit=limit))
+        self.limit = limit
+
+class SessionTimeoutException(SessionException):
+    def __init__(self, timeout, stdout='', stderr=''):
+        super(SessionTimeoutException, self).__init__(-1, stdout, "icommand timed out (time budget {timeout:.1f}s)\n{stderr}".format(
+            timeout=timeout, stderr=stderr
+        ))
+        self.timeout = timeout
+
+# default time budget for each icommand in seconds, and overrides for individual icommands, e.g. {'iput': 3600}.
+# None means no limit.
+COMMAND_TIMEOUT = getattr(settings, 'IRODS_COMMAND_TIMEOUT', None)
+COMMAND_TIMEOUTS = getattr(settings, 'IRODS_COMMAND_TIMEOUTS', {})
+
+_local = threading.local()
+
+class deadline(object):
+    """Context manager bounding the total time that icommands run in this thread may take.
+
+    Every blocking icommand started inside the block gets at most the time remaining before the
+    deadline, and fails immediately with SessionTimeoutException once it has passed.  Nested
+    deadlines can only shorten the outer one.  Streamed commands only obey per-command timeouts,
+    since they are usually consumed after the block (e.g. the request) has ended.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'deadline', None)
+        expires = time.time() + self.seconds
+        _local.deadline = expires if self._outer is None else min(expires, self._outer)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.deadline = self._outer
+        return False
+
+def _budget(icommand, timeout=None, use_deadline=True):
+    """Seconds an icommand may run: its own timeout, shrunk to fit the thread's deadline."""
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(icommand, COMMAND_TIMEOUT)
+    expires = getattr(_local, 'deadline', None) if use_deadline else None
+    if expires is not None:
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise SessionTimeoutException(0, '', "deadline passed before {icommand} could start".format(icommand=icommand))
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+class _Watchdog(object):
+    """Kills a child icommand that outlives its time budget."""
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.timeout = timeout
+        self.fired = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self):
+        if self.proc.poll() is None:
+            self.fired = True
+            try:
+                self.proc.kill()
+            except OSError:
+                pass  # exited in the meantime
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+# per-process cap on icommands whose output is being streamed, e.g. to download responses
+MAX_STREAMING_CHILDREN = getattr(settings, 'IRODS_MAX_STREAMING_CHILDREN', None)
+_streaming_slots = threading.BoundedSemaphore(MAX_STREAMING_CHILDREN) if MAX_STREAMING_CHILDREN else None
+
+class StreamingProcess(object):
+    """A running icommand whose stdout is consumed as a stream.
+
+    stderr is drained by a background thread so a chatty child can't block on a full pipe, the
+    child is killed and reaped when the stream is closed early (e.g. the client disconnects), and
+    a non-zero exit status is raised as a SessionException once stdout is exhausted.  Being
+    file-like, it can be handed straight to FileResponse, which closes it with the response.
+    """
+    CHUNK_SIZE = 65536
+    STDERR_LIMIT = 65536
+
+    def __init__(self, proc, slot=None, watchdog=None, traced=None, gated=None):
+        self.proc = proc
+        self._slot = slot
+        self._watchdog = watchdog
+        self._traced = traced
+        self._gated = gated  # (HostGate, token) to report the outcome to
+        self._done_callbacks = []
+        self._stderr = []
+        self._drain = threading.Thread(target=self._drain_stderr)
+        self._drain.daemon = True
+        self._drain.start()
+
+    def _drain_stderr(self):
+        kept = 0
+        for chunk in iter(lambda: self.proc.stderr.read(4096), b''):
+            if kept < self.STDERR_LIMIT:
+                self._stderr.append(chunk)
+                kept += len(chunk)
+
+    def _release(self, failed=False):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        if self._traced is not None:
+            self._traced.finish()
+        slot, self._slot = self._slot, None
+        if slot is not None:
+            slot.release()
+        gated, self._gated = self._gated, None
+        if gated is not None:
+            gated[0].release(gated[1], failed)
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    @property
+    def stderr(self):
+        return b''.join(self._stderr)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data:
+            self._finish()
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.CHUNK_SIZE), b'')
+
+    def add_done_callback(self, fn):
+        """Have fn called once stdout has been read to the end, with the SessionException raised for a failed
+        command or None.  It isn't called for streams closed early.
+        """
+        self._done_callbacks.append(fn)
+
+    def _finish(self):
+        returncode = self.proc.wait()
+        self._drain.join()
+        fired = self._watchdog is not None and self._watchdog.fired
+        self._release(fired or bool(returncode and any(e in self.stderr for e in OVERLOAD_ERRORS)))
+        error = None
+        if self._watchdog is not None and self._watchdog.fired:
+            error = SessionTimeoutException(self._watchdog.timeout, '', self.stderr)
+        elif returncode:
+            error = SessionException(returncode, '', self.stderr)
+        callbacks, self._done_callbacks = self._done_callbacks, []
+        for fn in callbacks:
+            fn(error)
+        if error is not None:
+            raise error
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._release()
+
+class CircuitOpenException(SessionException):
+    def __init__(self, host, port, retry_in):
+        super(CircuitOpenException, self).__init__(-1, '', "iRODS host {host}:{port} is failing, not sending it commands for another {retry_in:.0f}s".format(
+            host=host, port=port, retry_in=retry_in
+        ))
+        self.host = host
+        self.port = port
+
+class AdmissionException(SessionException):
+    def __init__(self, host, port, limit):
+        super(AdmissionException, self).__init__(-1, '', "Too many icommands in flight to {host}:{port} from this process (limit {limit})".format(
+            host=host, port=port, limit=limit
+        ))
+        self.host = host
+        self.port = port
+
+# per-process cap on icommands in flight to one iRODS host, and how long a command may wait for a slot
+MAX_COMMANDS_PER_HOST = getattr(settings, 'IRODS_MAX_COMMANDS_PER_HOST', None)
+ADMISSION_WAIT = getattr(settings, 'IRODS_ADMISSION_WAIT', 5)
+# consecutive failures (or calls slower than IRODS_BREAKER_SLOW_CALL seconds) that trip a host's circuit
+# breaker, and seconds the breaker stays open before letting a single probe command through
+BREAKER_FAILURES = getattr(settings, 'IRODS_BREAKER_FAILURES', None)
+BREAKER_SLOW_CALL = getattr(settings, 'IRODS_BREAKER_SLOW_CALL', None)
+BREAKER_RESET = getattr(settings, 'IRODS_BREAKER_RESET', 30)
+
+# stderr markers of a grid that can't be reached or is overloaded, as opposed to ordinary errors such as a
+# missing data object, which say nothing about the host's health
+OVERLOAD_ERRORS = ('SOCK', 'CONNECT_ERR', 'SYS_HEADER_READ', 'SYS_AGENT_INIT_ERR', 'SYS_EXCEED_CONNECT_CNT')
+
+class HostGate(object):
+    """Admission control and a circuit breaker for the icommands one process sends to an iRODS host.
+
+    admit() blocks while MAX_COMMANDS_PER_HOST commands are in flight and gives up with
+    AdmissionException after ADMISSION_WAIT seconds.  After BREAKER_FAILURES consecutive
+    failures the breaker opens and every command fails fast with CircuitOpenException.
+    Once BREAKER_RESET seconds have passed it goes half-open: one probe command, never a stream,
+    is let through, and its outcome closes the breaker again or re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, port, limit=None, failures=None, slow_call=None, reset=30):
+        self.host = host
+        self.port = port
+        self.limit = limit
+        self.failure_threshold = failures
+        self.slow_call = slow_call
+        self.reset = reset
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.in_flight = 0
+        self._probing = False
+        self._cond = threading.Condition()
+
+    def _check(self):
+        if self.state == self.OPEN:
+            retry_in = self.opened_at + self.reset - time.time()
+            if retry_in > 0:
+                raise CircuitOpenException(self.host, self.port, retry_in)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and self._probing:
+            raise CircuitOpenException(self.host, self.port, 0)
+
+    def check(self):
+        """Fail fast if the breaker is open, without taking a slot."""
+        with self._cond:
+            self._check()
+
+    def admit(self, wait=ADMISSION_WAIT):
+        """Wait for a slot.  Returns a token to hand back to release()."""
+        with self._cond:
+            self._check()
+            probe = self.state == self.HALF_OPEN
+            if self.limit:
+                give_up = time.time() + wait
+                while self.in_flight >= self.limit:
+                    remaining = give_up - time.time()
+                    if remaining <= 0:
+                        raise AdmissionException(self.host, self.port, self.limit)
+                    self._cond.wait(remaining)
+            if probe:
+                self._probing = True
+            self.in_flight += 1
+            return time.time(), probe, True
+
+    def enter(self, timed=False):
+        """Admit a command without taking a slot: a stream, which runs for as long as the client reads it,
+        or an async command, which mustn't block waiting for one.  The breaker still applies.  Only timed
+        commands count as failed for being slow, and only they may be the probe when half-open: a stream
+        would hold the probe for as long as its client reads, and one closed early says nothing about the
+        host, so streams fail fast until a timed command has closed the breaker again.
+        Returns a token to hand back to release().
+        """
+        with self._cond:
+            self._check()
+            probe = self.state == self.HALF_OPEN
+            if probe and not timed:
+                raise CircuitOpenException(self.host, self.port, 0)
+            if probe:
+                self._probing = True
+            return (time.time() if timed else None), probe, False
+
+    def release(self, token, failed):
+        started, probe, slot = token
+        with self._cond:
+            if slot:
+                self.in_flight -= 1
+                self._cond.notify()
+            failed = failed or bool(self.slow_call and started is not None and time.time() - started > self.slow_call)
+            if probe:
+                self._probing = False
+                self.failures = 0
+                if failed:
+                    self.state, self.opened_at = self.OPEN, time.time()
+                else:
+                    self.state = self.CLOSED
+            elif failed:
+                self.failures += 1
+                if self.failure_threshold and self.failures >= self.failure_threshold and self.state == self.CLOSED:
+                    self.state, self.opened_at = self.OPEN, time.time()
+            else:
+                self.failures = 0
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+def host_gate(host, port):
+    """The process-wide HostGate for an iRODS host, or None if neither limit nor breaker is configured."""
+    if not (MAX_COMMANDS_PER_HOST or BREAKER_FAILURES or BREAKER_SLOW_CALL):
+        return None
+    with _gates_lock:
+        if (host, port) not in _gates:
+            _gates[host, port] = HostGate(host, port, MAX_COMMANDS_PER_HOST, BREAKER_FAILURES, BREAKER_SLOW_CALL, BREAKER_RESET)
+        return _gates[host, port]
+
+# seconds a provider that couldn't be reached is left out of the rotation before a background thread health-checks
+# it again, and how long that check (a TCP connect to its port) may take
+PROVIDER_RETRY = getattr(settings, 'IRODS_PROVIDER_RETRY', 30)
+PROVIDER_CHECK_TIMEOUT = getattr(settings, 'IRODS_PROVIDER_CHECK_TIMEOUT', 2)
+
+# stderr markers of a provider that couldn't be connected to at all, so the command never ran there and
+# can safely be sent to another one.  SYS_EXCEED_CONNECT_CNT isn't among them: that provider is busy, not
+# down, and is left to its HostGate breaker
+UNREACHABLE_ERRORS = ('CONNECT_ERR', 'SYS_AGENT_INIT_ERR')
+
+def parse_providers(spec, default_port=1247):
+    """Reads a list of catalog providers: "host[:port[:weight]]" entries separated by commas or
+    whitespace, or a sequence of (host, port[, weight]) tuples.  Returns [(host, port, weight)],
+    or None for an empty spec.
+    """
+    if not spec:
+        return None
+    if isinstance(spec, string_types):
+        spec = [entry.split(':') for entry in spec.replace(',', ' ').split()]
+    providers = []
+    for entry in spec:
+        entry = tuple(entry)
+        port = int(entry[1]) if len(entry) > 1 and entry[1] else int(default_port)
+        weight = float(entry[2]) if len(entry) > 2 else 1.0
+        providers.append((entry[0], port, weight))
+    return providers or None
+
+class ProviderPool(object):
+    """The catalog providers of a zone, shared by the sessions of a process.
+
+    Sessions are spread over the providers in proportion to their weights.  A provider that can't
+    be connected to is marked down and left out of the rotation, as is one whose HostGate breaker
+    is open.  A background thread checks each down provider every PROVIDER_RETRY seconds and puts
+    it back once it accepts a TCP connection, so choosing never waits on a health check.
+    """
+    def __init__(self, providers, retry=PROVIDER_RETRY, check_timeout=PROVIDER_CHECK_TIMEOUT):
+        self.providers = [(host, port) for host, port, _ in providers]
+        self.weights = dict(((host, port), max(weight, 0)) for host, port, weight in providers)
+        self.retry = retry
+        self.check_timeout = check_timeout
+        self.down = {}  # (host, port) -> when it is due to be checked again
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def healthy(self, provider):
+        try:
+            sock = socket.create_connection(provider, self.check_timeout)
+        except (socket.error, socket.timeout):
+            return False
+        sock.close()
+        return True
+
+    def _usable(self, provider, now):
+        if provider in self.down:
+            return False
+        gate = host_gate(*provider)
+        return gate is None or gate.state != HostGate.OPEN or gate.opened_at + gate.reset <= now
+
+    def choose(self, exclude=()):
+        """Picks a provider at random by weight among those that are up.  Returns None if none is."""
+        now = time.time()
+        with self._lock:
+            candidates = [p for p in self.providers if p not in exclude and self._usable(p, now)]
+        if not candidates:
+            return None
+        # providers weighted zero are standbys, only used when nothing else is up
+        weighted = [p for p in candidates if self.weights[p] > 0]
+        if not weighted:
+            return candidates[0]
+        point = random.uniform(0, sum(self.weights[p] for p in weighted))
+        for provider in weighted:
+            point -= self.weights[provider]
+            if point <= 0:
+                return provider
+        return weighted[-1]
+
+    def mark_down(self, provider):
+        with self._lock:
+            self.down[provider] = time.time() + self.retry
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._check_down)
+                self._checker.daemon = True
+                self._checker.start()
+
+    def mark_up(self, provider):
+        with self._lock:
+            self.down.pop(provider, None)
+
+    def _check_down(self):
+        """Health-check down providers as they fall due, until none is left down."""
+        while True:
+            with self._lock:
+                if not self.down:
+                    self._checker = None
+                    return
+                now = time.time()
+                due = [p for p, when in self.down.items() if when <= now]
+                wait = max(min(self.down.values()) - now, 0.1)
+            if not due:
+                time.sleep(wait)
+                continue
+            for provider in due:
+                if self.healthy(provider):
+                    self.mark_up(provider)
+                else:
+                    self.mark_down(provider)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def provider_pool(providers):
+    """The process-wide ProviderPool for a list of (host, port, weight) providers."""
+    key = tuple(providers)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProviderPool(providers)
+        return _pools[key]
+
 IRodsEnv = namedtuple(
     'IRodsEnv',
-    ['pk','host','port','def_res','home_coll','cwd','username','zone','auth']
+    ['pk','host','port','def_res','home_coll','cwd','username','zone','auth','providers']
 )
+IRodsEnv.__new__.__defaults__ = (None,)  # providers: a single host unless given
 
 class Session(object):
     """A set of methods to start, close and manage multiple
@@ -32,6 +470,8 @@ class Session(object):
         self.icommands_path = icommands_path or settings.IRODS_ICOMMANDS_PATH # where the icommand binaries are
         self.session_id = session_id
         self.session_path = "{root}/{session_id}".format(root=self.root, session_id=self.session_id)
+        self.host_key = None
+        self.pool = None  # the ProviderPool, when the environment lists several providers
 
     def create_environment(self, myEnv=None):
         """Creates session files in temporary directory.
@@ -56,9 +496,20 @@ class Session(object):
                cwd=settings.IRODS_CWD,
                username=settings.IRODS_USERNAME,
                zone=settings.IRODS_ZONE,
-               auth=settings.IRODS_AUTH
+               auth=settings.IRODS_AUTH,
+               providers=getattr(settings, 'IRODS_PROVIDERS', None)
             )
 
+        # sessions of an environment with several providers each stick to one of them, until it fails
+        providers = parse_providers(getattr(myEnv, 'providers', None), myEnv.port)
+        if providers:
+            self.pool = provider_pool(providers)
+            self.host_key = self.pool.choose() or self.pool.providers[0]
+        else:
+            self.pool = None
+            self.host_key = (myEnv.host, int(myEnv.port))
+        host, port = self.host_key
+
         # create irods_environment.json file
         if not os.path.exists(self.session_path):
             os.makedirs(self.session_path)
@@ -75,8 +526,8 @@ class Session(object):
                 "irods_user_name": "{username}",
                 "irods_zone_name": "{zone}"
             """).format(
-                host=myEnv.host,
-                port=myEnv.port,
+                host=host,
+                port=port,
                 def_res=myEnv.def_res,
                 home_coll=myEnv.home_coll,
                 username=myEnv.username,
@@ -139,53 +590,146 @@ class Session(object):
         envfile.close()
         return user_name
 
-    def run(self, icommand, data=None, *args):
-        """Runs an icommand with optional argument list and
-        returns tuple (stdout, stderr) from subprocess execution.
-
-        Set of valid commands can be extended.
-        """
-
+    def _environ(self):
         myenv = os.environ.copy()
         myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
         myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
+        if self.pool is not None:
+            # the provider this session is on, which overrides irods_environment.json after a failover
+            myenv['IRODS_HOST'] = self.host_key[0]
+            myenv['IRODS_PORT'] = str(self.host_key[1])
+        return myenv
+
+    def _fail_over(self, tried):
+        """Mark the current provider down and switch to another that hasn't been tried.
+        Returns False if there is none to switch to.
+        """
+        if self.pool is None:
+            return False
+        tried.add(self.host_key)
+        self.pool.mark_down(self.host_key)
+        provider = self.pool.choose(exclude=tried)
+        if provider is None:
+            return False
+        self.host_key = provider
+        return True
 
-        cmdStr = os.path.join(self.icommands_path, icommand)
-        argList = [cmdStr]
+    def _pass_breaker(self, tried, enter):
+        """Get a command through the breaker of this session's provider, failing over to the next
+        provider while it is open.  enter(gate) passes one gate, returning the token to release, if any.
+        Returns (gate, token), with gate None when no breaker is configured.
+        """
+        gate = self.gate()
+        while gate:
+            try:
+                return gate, enter(gate)
+            except CircuitOpenException:
+                if not self._fail_over(tried):
+                    raise
+            gate = self.gate()
+        return None, None
+
+    def gate(self):
+        """The HostGate for the host this session talks to, read from irods_environment.json
+        for sessions that share an environment created elsewhere.
+        """
+        if self.host_key is None and self.session_file_exists():
+            with open(os.path.join(self.session_path, "irods_environment.json")) as envfile:
+                env = json.load(envfile)
+            self.host_key = (env['irods_host'], int(env['irods_port']))
+        if self.host_key is None:
+            return None
+        return host_gate(*self.host_key)
+
+    def _argv(self, icommand, args):
+        argList = [os.path.join(self.icommands_path, icommand)]
         argList.extend(args)
+        return argList
 
-        stdin=None
-        if data:
-            stdin = StringIO(data)
+    def _communicate(self, argList, data=None, timeout=None):
+        """Runs a command to completion within its time budget and
+        returns tuple (returncode, stdout, stderr).  With several providers,
+        a command that couldn't reach its provider is sent to the next one.
+        """
+        tried = set()
+        while True:
+            try:
+                returncode, stdout, stderr = self._communicate_once(argList, data, timeout)
+            except CircuitOpenException:
+                if self._fail_over(tried):
+                    continue
+                raise
+            if returncode and any(e in stderr for e in UNREACHABLE_ERRORS) and self._fail_over(tried):
+                continue
+            return returncode, stdout, stderr
+
+    def _communicate_once(self, argList, data=None, timeout=None):
+        budget = _budget(os.path.basename(argList[0]), timeout)
+        gate = self.gate()
+        token = gate.admit() if gate else None
+        failed = False
+        traced = tracing.record(os.path.basename(argList[0]), argList[1:])
+        try:
+            proc = subprocess.Popen(
+                argList,
+                stdin = subprocess.PIPE if data else None,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                env = self._environ()
+            )
+            watchdog = _Watchdog(proc, budget)
+            try:
+                stdout, stderr = proc.communicate(input=data) if data else proc.communicate()
+            except BaseException:
+                # e.g. Celery's SoftTimeLimitExceeded interrupting the wait: don't leave the child behind
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                raise
+            finally:
+                watchdog.cancel()
+
+            failed = watchdog.fired or bool(proc.returncode and any(e in stderr for e in OVERLOAD_ERRORS))
+        finally:
+            if traced is not None:
+                traced.finish()
+            if gate:
+                gate.release(token, failed)
+
+        if watchdog.fired:
+            raise SessionTimeoutException(budget, stdout, stderr)
+        return proc.returncode, stdout, stderr
+
+    def run(self, icommand, data=None, *args, **kwargs):
+        """Runs an icommand with optional argument list and
+        returns tuple (stdout, stderr) from subprocess execution.
 
-        proc = subprocess.Popen(
-            argList,
-            stdin=subprocess.PIPE if stdin else None,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            env = myenv
-        )
-        stdout, stderr = proc.communicate(input=data) if stdin else proc.communicate()
+        Set of valid commands can be extended.  A timeout keyword argument
+        overrides the configured time budget for this call.
+        """
+        returncode, stdout, stderr = self._communicate(self._argv(icommand, args), data, kwargs.get('timeout'))
 
-        if proc.returncode:
-            raise SessionException(proc.returncode, stdout, stderr)
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
         else:
             return stdout, stderr
 
     def run_safe(self, icommand, data=None, *args):
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
-        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
-
-        cmdStr = os.path.join(self.icommands_path, icommand)
-        argList = [cmdStr]
-        argList.extend(args)
+        """Starts an icommand and returns the Popen without waiting for it.  It is sent to a provider
+        whose breaker is closed, but since its output goes straight to the caller, a provider that turns
+        out to be unreachable isn't retried.
+        """
+        self._pass_breaker(set(), lambda gate: gate.check())
+        myenv = self._environ()
+        argList = self._argv(icommand, args)
 
         stdin=None
         if data:
-            print data
+            print(data)
             stdin = StringIO(data)
 
+        budget = _budget(icommand)
+        tracing.record(icommand, args)
         proc = subprocess.Popen(
             argList,
             stdin=stdin,
@@ -193,55 +737,62 @@ class Session(object):
             stderr = subprocess.PIPE,
             env = myenv
         )
+        _Watchdog(proc, budget)
         return proc
 
+    def stream(self, icommand, data=None, *args):
+        """Starts an icommand whose stdout is to be streamed and returns
+        it as a StreamingProcess.  Raises StreamLimitException if this process
+        already has IRODS_MAX_STREAMING_CHILDREN streams open.
+        """
+        budget = _budget(icommand, use_deadline=False)
+        gate, token = self._pass_breaker(set(), lambda gate: gate.enter())
+        if _streaming_slots is not None and not _streaming_slots.acquire(False):
+            if gate:
+                gate.release(token, False)
+            raise StreamLimitException(MAX_STREAMING_CHILDREN)
+
+        traced = tracing.record(icommand, args)
+        try:
+            proc = subprocess.Popen(
+                self._argv(icommand, args),
+                stdin = subprocess.PIPE if data else None,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                env = self._environ()
+            )
+        except:
+            if _streaming_slots is not None:
+                _streaming_slots.release()
+            if traced is not None:
+                traced.finish()
+            if gate:
+                gate.release(token, False)
+            raise
+        if data:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        return StreamingProcess(proc, _streaming_slots, _Watchdog(proc, budget), traced, (gate, token) if gate else None)
+
     def runbatch(self, *icommands):
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
-        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
         return_codes = []
 
         for icommand, args in icommands:
-            cmdStr = os.path.join(self.icommands_path, icommand)
-            argList = [cmdStr]
-            argList.extend(args)
-
-            return_codes.append(subprocess.Popen(
-                argList,
-                stdout = subprocess.PIPE,
-                stderr = subprocess.PIPE,
-                env = myenv
-            ).communicate())
+            returncode, stdout, stderr = self._communicate(self._argv(icommand, args))
+            return_codes.append((stdout, stderr))
         return return_codes
 
-    def admin(self, *args):
+    def admin(self, *args, **kwargs):
         """Runs the iadmin icommand with optional argument list and
         returns tuple (stdout, stderr) from subprocess execution.
         """
 
         # should probably also add a condition to restrict
         # possible values for icommandsDir
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = "%s/irods_environment.json" % (self.session_path)
-        myenv['IRODS_AUTHENTICATION_FILE'] = "%s/.irodsA" % (self.session_path)
-
-        cmdStr = "{icommands}/iadmin".format(icommands=self.icommands_path)
-
-        argList = [cmdStr]
-        argList.extend(args)
-
-        proc = subprocess.Popen(
-            argList,
-            stdin = None,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            env = myenv
-        )
-
-        stdout, stderr = proc.communicate()
+        returncode, stdout, stderr = self._communicate(self._argv('iadmin', args), timeout=kwargs.get('timeout'))
 
-        if proc.returncode:
-            raise SessionException(proc.returncode, stdout, stderr)
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
         else:
             return stdout, stderr
 
@@ -0,0 +1,103 @@
+"""
+Metadata cache for IrodsStorage shared by every process through Django's cache framework.
+
+exists/size/getAVU results are cached under keys that embed the generation counter of the path
+and of each of its ancestor collections.  A write bumps the generation of the path it touched, which
+orphans the cached entries of that path and of everything beneath it in every process at once,
+without having to find and delete them.  Orphaned entries simply age out of the cache.  Collection
+listings additionally carry a listing generation, bumped by writes to any direct child.
+
+Enable it by naming a cache alias in IRODS_METADATA_CACHE; IRODS_METADATA_CACHE_TIMEOUT bounds how
+long an entry may be served (default 300 seconds).
+"""
+
+import hashlib
+import posixpath
+import time
+
+from django.conf import settings
+
+_PREFIX = 'irods:'
+
+
+def _digest(*parts):
+    text = u'\0'.join(p.decode('utf-8') if isinstance(p, bytes) else u'%s' % (p,) for p in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _lineage(path):
+    """The path and each of its ancestor collections, root first."""
+    path = posixpath.normpath(path)
+    lineage = [path]
+    while path not in ('/', ''):
+        path = posixpath.dirname(path)
+        lineage.append(path)
+    return lineage[::-1]
+
+
+class MetadataCache(object):
+    def __init__(self, cache, timeout=300):
+        self.cache = cache
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls):
+        alias = getattr(settings, 'IRODS_METADATA_CACHE', None)
+        if not alias:
+            return None
+        from django.core.cache import caches
+        return cls(caches[alias], getattr(settings, 'IRODS_METADATA_CACHE_TIMEOUT', 300))
+
+    def _generation_keys(self, path):
+        return [_PREFIX + 'gen:' + _digest(p) for p in _lineage(path)]
+
+    def _listing_generation_key(self, path):
+        return _PREFIX + 'lgen:' + _digest(posixpath.normpath(path))
+
+    def _generations(self, path, *more_keys):
+        keys = self._generation_keys(path) + list(more_keys)
+        found = self.cache.get_many(keys)
+        missing = [k for k in keys if k not in found]
+        if missing:
+            # start unknown (never written, or evicted) counters from the clock rather than zero, so an evicted
+            # counter can't come back at a value that old entries were keyed with
+            for key in missing:
+                self.cache.add(key, int(time.time() * 1000000), None)
+            found.update(self.cache.get_many(missing))
+        return [found.get(k) for k in keys]
+
+    def key(self, op, path, *extra):
+        """
+        The cache key for a lookup, at the current generations.  Take it before querying iRODS and store the result
+        under it, so a write that lands in between leaves the result orphaned rather than cached as current.
+        """
+        return _PREFIX + op + ':' + _digest(path, *(extra + tuple(self._generations(path))))
+
+    def listing_key(self, path, *extra):
+        """
+        Like key(), for lookups that depend on a collection's children: it also changes whenever something directly
+        in the collection is written.
+        """
+        generations = self._generations(path, self._listing_generation_key(path))
+        return _PREFIX + 'ls:' + _digest(path, *(extra + tuple(generations)))
+
+    def get(self, key):
+        """:return: a one-element list holding the cached value, or None on a miss"""
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, [value], self.timeout)
+
+    def _bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, int(time.time() * 1000000), None)
+
+    def invalidate(self, path):
+        """
+        Bump the generation of a path, invalidating what is cached about it and everything beneath it, as well as
+        the listing of its parent collection.
+        """
+        self._bump(self._generation_keys(path)[-1])
+        self._bump(self._listing_generation_key(posixpath.dirname(posixpath.normpath(path))))
@@ -0,0 +1,59 @@
+from django.conf import settings
+
+from django_irods import icommands
+from django_irods import tracing
+
+
+class IrodsDeadlineMiddleware(object):
+    """
+    Bound the icommand time of each request to IRODS_REQUEST_DEADLINE seconds.  Every blocking
+    icommand run while handling the request gets the time left before the deadline as its budget,
+    so a stalled catalog fails the request with SessionTimeoutException instead of pinning the worker.
+    """
+    def process_request(self, request):
+        seconds = getattr(settings, 'IRODS_REQUEST_DEADLINE', None)
+        if seconds:
+            request._irods_deadline = icommands.deadline(seconds)
+            request._irods_deadline.__enter__()
+
+    def _clear(self, request):
+        irods_deadline = getattr(request, '_irods_deadline', None)
+        if irods_deadline is not None:
+            irods_deadline.__exit__(None, None, None)
+            request._irods_deadline = None
+
+    def process_exception(self, request, exception):
+        self._clear(request)
+
+    def process_response(self, request, response):
+        self._clear(request)
+        return response
+
+
+class IrodsTraceMiddleware(object):
+    """
+    Trace the icommands each request runs (see django_irods.tracing) and log a summary when it ends.  With
+    DEBUG on, the summary is also sent back in the IRODS_TRACE_HEADER header (default X-Irods-Trace).
+    """
+    def process_request(self, request):
+        if tracing.ENABLED:
+            request._irods_trace = tracing.trace(request.path)
+            request._irods_trace.__enter__()
+
+    def _finish(self, request):
+        irods_trace = getattr(request, '_irods_trace', None)
+        if irods_trace is None:
+            return None
+        irods_trace.__exit__(None, None, None)
+        request._irods_trace = None
+        irods_trace.tracer.report()
+        return irods_trace.tracer
+
+    def process_exception(self, request, exception):
+        self._finish(request)
+
+    def process_response(self, request, response):
+        tracer = self._finish(request)
+        if tracer is not None and getattr(settings, 'DEBUG', False):
+            response[getattr(settings, 'IRODS_TRACE_HEADER', 'X-Irods-Trace')] = tracer.summary()[:4000]
+        return response
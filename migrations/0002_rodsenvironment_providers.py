@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_irods', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rodsenvironment',
+            name='providers',
+            field=models.TextField(default=b'', help_text=b'Optional host[:port[:weight]] entries, separated by commas, to spread sessions over and fail over between instead of the single host above', verbose_name=b'Catalog providers', blank=True),
+        ),
+    ]
@@ -11,6 +11,9 @@ class RodsEnvironment(m.Model):
     username = m.CharField(max_length=255)
     zone = m.TextField()
     auth = m.TextField(verbose_name='Password')
+    providers = m.TextField(verbose_name='Catalog providers', blank=True, default='',
+                            help_text='Optional host[:port[:weight]] entries, separated by commas, to spread '
+                                      'sessions over and fail over between instead of the single host above')
 
     def __unicode__(self):
         return u'{username}@{host}:{port}//{def_res}/{home_coll}'.format(
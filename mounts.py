@@ -0,0 +1,235 @@
+"""
+Shared irodsFs mounts for the tasks of a worker process.
+
+MountManager keeps one irodsFs FUSE mount per (environment, collection) and hands it to every task that
+asks, counting references.  A mount that nobody holds any more is only unmounted once it has been idle
+for IRODS_MOUNT_IDLE seconds, so a stream of tasks over the same collection mounts it once.  A mount
+whose irodsFs process has died (the mount point fails with "Transport endpoint is not connected") is
+detected when it is next acquired, and is lazily unmounted and mounted afresh.
+
+Through a mount, tasks read data objects in place, with seeks and mmap, instead of copying them out with
+iget first::
+
+    with manager().mounted(session, environment.pk, '/hydroZone/home/proxy/abc123') as path:
+        with open(os.path.join(path, 'data/contents/big.nc'), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+Mount points are created under IRODS_MOUNT_ROOT, a fresh one for every mount, so unmounting an old mount can
+never detach a newer mount of the same collection.
+"""
+
+import atexit
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from django_irods.icommands import Session
+
+logger = logging.getLogger(__name__)
+
+MOUNT_ROOT = getattr(settings, 'IRODS_MOUNT_ROOT', os.path.join(tempfile.gettempdir(), 'django_irods_mounts'))
+IDLE_TIMEOUT = getattr(settings, 'IRODS_MOUNT_IDLE', 300)
+
+
+def _unmount(mount):
+    # -z: lazy, so files still open through the mount don't keep it busy
+    subprocess.call(['fusermount', '-uz', mount.path])
+    try:
+        os.rmdir(mount.path)
+    except OSError:
+        pass
+    if mount.session_path is not None:
+        shutil.rmtree(mount.session_path, ignore_errors=True)
+
+
+class Mount(object):
+    def __init__(self, key, path, collection):
+        self.key = key
+        self.path = path
+        self.collection = collection
+        self.session_path = None  # the private session irodsFs runs in
+        self.refs = 0
+        self.idle_since = None
+        self.ready = threading.Event()  # set once mounting has finished, successfully or not
+        self.error = None
+
+    def healthy(self):
+        try:
+            os.stat(self.path)
+        except OSError as e:
+            if e.errno == errno.ENOTCONN:
+                return False
+            raise
+        return os.path.ismount(self.path)
+
+
+class MountManager(object):
+    def __init__(self, root=MOUNT_ROOT, idle_timeout=IDLE_TIMEOUT):
+        self.root = root
+        self.idle_timeout = idle_timeout
+        self.mounts = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _mount(self, session, mount):
+        if not os.path.isdir(mount.path):
+            os.makedirs(mount.path)
+        # irodsFs mounts the working collection, so it runs in a private copy of the session's environment whose
+        # working collection is the one to mount; an icd on the shared session would move every other thread's
+        # relative paths
+        private = Session(session.root, session.icommands_path, session_id='mount-' + os.path.basename(mount.path))
+        mount.session_path = private.session_path
+        if not os.path.isdir(private.session_path):
+            os.makedirs(private.session_path)
+        with open(os.path.join(session.session_path, 'irods_environment.json')) as f:
+            env = json.load(f)
+        env['irods_cwd'] = mount.collection
+        with open(os.path.join(private.session_path, 'irods_environment.json'), 'w') as f:
+            json.dump(env, f)
+        auth = os.path.join(session.session_path, '.irodsA')
+        if os.path.exists(auth):
+            shutil.copy(auth, os.path.join(private.session_path, '.irodsA'))
+        private.host_key = session.host_key
+        private.pool = session.pool
+        private.run('irodsFs', None, mount.path)
+
+    def _establish(self, session, mount, stale=None):
+        """Mount a Mount this thread has registered, outside the lock, and let any threads waiting on it go."""
+        try:
+            if stale is not None:
+                _unmount(stale)
+            self._mount(session, mount)
+        except BaseException as e:
+            mount.error = e
+            _unmount(mount)  # whatever irodsFs got as far as mounting, and the mount point
+            with self._lock:
+                if self.mounts.get(mount.key) is mount:
+                    del self.mounts[mount.key]
+            raise
+        finally:
+            mount.ready.set()
+
+    def acquire(self, session, environment_key, collection=None):
+        """
+        Get a reference to a mount of a collection, mounting it if no task has it mounted.  Mounting happens
+        outside the manager's lock, so other collections can be acquired and released meanwhile; tasks
+        asking for a collection that is being mounted wait for that mount.
+        :param session: the icommands Session to mount with, if a mount is needed
+        :param environment_key: what identifies the environment (the user) the session runs as
+        :param collection: the absolute collection path; the session's working collection if None
+        :return: a Mount, to be given back to release()
+        """
+        if collection is None:
+            collection = session.run('ipwd', None)[0].strip()
+        key = (environment_key, collection.rstrip('/') or '/')
+        digest = hashlib.sha1(u'{0}\0{1}'.format(*key).encode('utf-8')).hexdigest()
+
+        def new_mount():
+            return Mount(key, os.path.join(self.root, '{0}-{1}'.format(digest, uuid.uuid4().hex[:12])), key[1])
+
+        while True:
+            with self._lock:
+                mount = self.mounts.get(key)
+                created = mount is None
+                if created:
+                    mount = self.mounts[key] = new_mount()
+                mount.refs += 1
+                mount.idle_since = None
+            if created:
+                self._establish(session, mount)
+                return mount
+
+            mount.ready.wait()
+            if mount.error is not None:
+                self.release(mount)
+                raise mount.error
+            if mount.healthy():
+                return mount
+
+            # the irodsFs process behind the mount died: the first thread to notice mounts it afresh
+            with self._lock:
+                mount.refs -= 1
+                if self.mounts.get(key) is not mount:
+                    continue
+                logger.warning("irodsFs mount of %s at %s went stale, remounting", collection, mount.path)
+                fresh = self.mounts[key] = new_mount()
+                fresh.refs += 1
+            self._establish(session, fresh, stale=mount)
+            return fresh
+
+    def release(self, mount):
+        """Give back a reference from acquire().  The mount stays up until it has been idle for the idle timeout."""
+        with self._lock:
+            mount.refs -= 1
+            if mount.refs <= 0:
+                mount.refs = 0
+                mount.idle_since = time.time()
+                self._start_reaper()
+
+    @contextmanager
+    def mounted(self, session, environment_key, collection=None):
+        """Context manager giving the local path of a mounted collection for the duration of the block."""
+        mount = self.acquire(session, environment_key, collection)
+        try:
+            yield mount.path
+        finally:
+            self.release(mount)
+
+    def reap(self, force=False):
+        """Unmount the mounts that have been idle for the idle timeout (every idle mount, if force)."""
+        now = time.time()
+        with self._lock:
+            idle = [mount for mount in self.mounts.values()
+                    if mount.idle_since is not None and (force or now - mount.idle_since >= self.idle_timeout)]
+            for mount in idle:
+                del self.mounts[mount.key]
+        for mount in idle:
+            _unmount(mount)
+
+    def close(self):
+        """Unmount everything, e.g. as the worker exits."""
+        with self._lock:
+            mounts = list(self.mounts.values())
+            self.mounts.clear()
+        for mount in mounts:
+            _unmount(mount)
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+
+        def reap_forever():
+            while True:
+                time.sleep(max(self.idle_timeout / 2.0, 1))
+                try:
+                    self.reap()
+                except Exception:
+                    logger.exception("Reaping idle irodsFs mounts failed")
+        self._reaper = threading.Thread(target=reap_forever)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def manager():
+    """The MountManager of this worker process."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = MountManager()
+            atexit.register(_manager.close)
+        return _manager
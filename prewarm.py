@@ -0,0 +1,122 @@
+"""
+Rebuilding stale bags of popular resources ahead of demand.
+
+A bag is rebuilt when a download finds its resource's bag_modified AVU set to "true", so the first
+person to download after an edit waits for the whole build.  With IRODS_BAG_ACCESS_LOG naming a local
+SQLite file, downloads are counted per resource id (with the decaying scores of tiering.AccessLog), and
+the prewarm_bags task rebuilds the stale bags of the most popular resources before anyone asks:
+
+* stale bags are found with a single metadata query for bag_modified = "true";
+* they are rebuilt most popular first, skipping resources scoring under IRODS_PREWARM_MIN_SCORE;
+* a run stops after IRODS_PREWARM_MAX_BAGS bags or IRODS_PREWARM_MAX_SECONDS seconds, skips bags
+  whose collections hold more than the IRODS_PREWARM_MAX_BYTES left in its I/O budget, and doesn't
+  start at all while the host's load average exceeds IRODS_PREWARM_MAX_LOAD.
+
+Bags whose build is already running elsewhere (see bagging.rebuild_bag) are skipped rather than waited for.
+
+The log is a local file, so the task must run on the web host that writes it: set IRODS_WEB_HOST_QUEUE and
+run a worker for that queue there (see django_irods.routing).  Schedule the task periodically, e.g. with
+celery beat.
+"""
+
+import os
+import posixpath
+import threading
+import time
+
+from django.conf import settings
+
+from django_irods import bagging
+from django_irods.icommands import SessionException
+from django_irods.tiering import AccessLog
+
+MIN_SCORE = getattr(settings, 'IRODS_PREWARM_MIN_SCORE', 2.0)
+MAX_BAGS = getattr(settings, 'IRODS_PREWARM_MAX_BAGS', 20)
+MAX_SECONDS = getattr(settings, 'IRODS_PREWARM_MAX_SECONDS', 600)
+MAX_BYTES = getattr(settings, 'IRODS_PREWARM_MAX_BYTES', 50 * 1024 ** 3)
+MAX_LOAD = getattr(settings, 'IRODS_PREWARM_MAX_LOAD', None)
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def download_log():
+    """The process-wide AccessLog of bag downloads, or None if IRODS_BAG_ACCESS_LOG isn't set."""
+    global _log
+    path = getattr(settings, 'IRODS_BAG_ACCESS_LOG', None)
+    if not path:
+        return None
+    with _log_lock:
+        if _log is None:
+            _log = AccessLog(path)
+        return _log
+
+
+def record_download(res_id):
+    """Count a download from a resource, if download statistics are being kept."""
+    log = download_log()
+    if log is not None:
+        log.record(res_id)
+
+
+class BagPrewarmer(object):
+    def __init__(self, storage, log, min_score=MIN_SCORE, max_bags=MAX_BAGS, max_seconds=MAX_SECONDS,
+                 max_bytes=MAX_BYTES, max_load=MAX_LOAD):
+        """
+        :param storage: the IrodsStorage holding the resource collections
+        :param log: the AccessLog of downloads per resource id
+        """
+        self.storage = storage
+        self.log = log
+        self.min_score = min_score
+        self.max_bags = max_bags
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.max_load = max_load
+
+    def candidates(self):
+        """:return: [(res_id, score)] for resources with stale bags, most popular first"""
+        self.log.flush()
+        stale = [posixpath.basename(coll.rstrip('/')) for coll in self.storage.find_collections('bag_modified', 'true')]
+        scores = self.log.scores(stale)
+        popular = [(res_id, score) for res_id, score in scores.items() if score >= self.min_score]
+        return sorted(popular, key=lambda item: -item[1])
+
+    def overloaded(self):
+        if not self.max_load:
+            return False
+        try:
+            return os.getloadavg()[0] > self.max_load
+        except OSError:
+            return False
+
+    def run(self):
+        """
+        Rebuild stale bags within the budget.
+        :return: dict listing the resource ids rebuilt, those skipped for the I/O budget or because they were being
+            built elsewhere, those that failed and the seconds and bytes spent
+        """
+        report = {'rebuilt': [], 'skipped': [], 'failed': [], 'seconds': 0.0, 'bytes': 0}
+        if self.overloaded():
+            return report
+        started = time.time()
+        stream_bag = getattr(settings, 'IRODS_STREAM_BAGS', False)
+        for res_id, _ in self.candidates():
+            if len(report['rebuilt']) >= self.max_bags or time.time() - started >= self.max_seconds:
+                break
+            try:
+                size = sum(member[0] or 0 for member in self.storage.collection_members(res_id).values())
+                if report['bytes'] + size > self.max_bytes:
+                    report['skipped'].append(res_id)
+                    continue
+                built = bagging.rebuild_bag(self.storage, res_id, stream_bag, wait=False)
+            except SessionException as e:
+                report['failed'].append({'res_id': res_id, 'error': e.stderr.strip()})
+                continue
+            if not built:
+                report['skipped'].append(res_id)
+                continue
+            report['rebuilt'].append(res_id)
+            report['bytes'] += size
+        report['seconds'] = time.time() - started
+        return report
@@ -0,0 +1,191 @@
+"""
+A builder for iRODS general queries (GenQuery), run through iquest.
+
+A Query names the columns to select and accumulates conditions, then streams typed rows as iquest
+produces them, so one query replaces walking collections with an imeta call apiece::
+
+    stale = Query(session, 'COLL_NAME') \\
+        .filter('META_COLL_ATTR_NAME', '=', 'bag_modified') \\
+        .filter('META_COLL_ATTR_VALUE', '=', 'true')
+    for row in stale:
+        print(row.coll_name)
+
+Large result sets are paged by key rather than by offset: order on a column, remember the last value
+seen and start the next page with after()::
+
+    page = Query(session, 'DATA_NAME', 'DATA_SIZE').filter('COLL_NAME', '=', coll).order_by('DATA_NAME').limit(100)
+    rows = list(page.after('DATA_NAME', last_name))
+"""
+
+import calendar
+from collections import namedtuple
+from datetime import datetime
+
+from django_irods.icommands import SessionException
+
+_SEPARATOR = '\x1f'  # ASCII unit separator, which won't turn up in names or values
+_NO_ROWS = 'CAT_NO_ROWS_FOUND'
+OPERATORS = ('=', '<>', '<', '>', '<=', '>=', 'like', 'not like', 'in', 'between')
+
+_row_types = {}
+
+
+def _text(data):
+    # iquest's output is bytes, which is already str on Python 2
+    return data if isinstance(data, str) else data.decode('utf-8', 'replace')
+
+
+def _convert(column, value):
+    if not value:
+        return value
+    if column.endswith(('_SIZE', '_ID', '_REPL_NUM', '_REPL_STATUS')):
+        return int(value)
+    if column.endswith('_TIME'):
+        return datetime.utcfromtimestamp(int(value))
+    return value
+
+
+def _quote(value):
+    if isinstance(value, datetime):
+        # _TIME columns hold zero-padded epoch seconds and compare as strings, so datetimes (as rows return them)
+        # go back to that form, e.g. for after() on a time column
+        value = '%011d' % calendar.timegm(value.utctimetuple())
+    value = '%s' % (value,)
+    if "'" in value:
+        raise ValueError("GenQuery can't express values containing a single quote: {value}".format(value=value))
+    return "'" + value + "'"
+
+
+class Query(object):
+    def __init__(self, session, *columns, **kwargs):
+        """
+        :param session: the icommands Session to run iquest in
+        :param columns: GenQuery column names to select, e.g. 'COLL_NAME', 'DATA_SIZE'
+        :param zone: the zone to query, if not the session's own
+        """
+        if not columns:
+            raise ValueError("A query needs at least one column")
+        self.session = session
+        self.columns = tuple(columns)
+        self.zone = kwargs.get('zone')
+        self.conditions = ()
+        self.ordering = {}
+        self.max_rows = None
+
+    def _clone(self, **changes):
+        clone = Query.__new__(Query)
+        clone.__dict__.update(self.__dict__)
+        clone.__dict__.update(changes)
+        return clone
+
+    def filter(self, column, op, value):
+        """
+        Add a condition.  Conditions on different columns are ANDed together.
+        :param op: one of OPERATORS; 'in' takes a sequence of values and 'between' a pair
+        """
+        op = op.lower()
+        if op not in OPERATORS:
+            raise ValueError("Unsupported GenQuery operator: {op}".format(op=op))
+        if op == 'in':
+            rhs = '(' + ', '.join(_quote(v) for v in value) + ')'
+        elif op == 'between':
+            rhs = '{low} {high}'.format(low=_quote(value[0]), high=_quote(value[1]))
+        else:
+            rhs = _quote(value)
+        return self._clone(conditions=self.conditions + ('{column} {op} {rhs}'.format(column=column, op=op, rhs=rhs),))
+
+    def avu(self, attribute, value=None, target='COLL'):
+        """Match objects carrying a metadata attribute (and value); target is 'COLL', 'DATA', 'RESC' or 'USER'."""
+        query = self.filter('META_{target}_ATTR_NAME'.format(target=target), '=', attribute)
+        if value is not None:
+            query = query.filter('META_{target}_ATTR_VALUE'.format(target=target), '=', value)
+        return query
+
+    def order_by(self, column, descending=False):
+        """Have iquest sort on a selected column."""
+        if column not in self.columns:
+            raise ValueError("Can only order on a selected column: {column}".format(column=column))
+        ordering = dict(self.ordering)
+        ordering[column] = 'ORDER_DESC' if descending else 'ORDER'
+        return self._clone(ordering=ordering)
+
+    def after(self, column, value):
+        """Keyset paging: only rows past value on an ordered column.  Time columns take the datetime from a row."""
+        if value is None:
+            return self
+        op = '<' if self.ordering.get(column) == 'ORDER_DESC' else '>'
+        return self.filter(column, op, value)
+
+    def limit(self, max_rows):
+        """Stop after max_rows rows; iquest is killed rather than left to page through the rest."""
+        return self._clone(max_rows=max_rows)
+
+    @property
+    def row_type(self):
+        fields = tuple(c.lower() for c in self.columns)
+        if fields not in _row_types:
+            _row_types[fields] = namedtuple('Row', fields)
+        return _row_types[fields]
+
+    def genquery(self):
+        select = ', '.join(
+            '{order}({column})'.format(order=self.ordering[c], column=c) if c in self.ordering else c
+            for c in self.columns
+        )
+        if self.conditions:
+            return 'SELECT {select} WHERE {where}'.format(select=select, where=' AND '.join(self.conditions))
+        return 'SELECT {select}'.format(select=select)
+
+    def _args(self):
+        args = ['--no-page']
+        if self.zone:
+            args.extend(['-z', self.zone])
+        args.append(_SEPARATOR.join(['%s'] * len(self.columns)))
+        args.append(self.genquery())
+        return args
+
+    def _lines(self, proc):
+        pending = b''
+        for chunk in proc:
+            pending += chunk
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield _text(line)
+        if pending:
+            yield _text(pending)
+
+    def __iter__(self):
+        """Stream result rows as iquest prints them."""
+        row_type = self.row_type
+        count = 0
+        no_rows = False
+        proc = self.session.stream('iquest', None, *self._args())
+        try:
+            for line in self._lines(proc):
+                if line.startswith(_NO_ROWS):
+                    no_rows = True
+                    continue
+                if not line:
+                    continue
+                values = line.split(_SEPARATOR)
+                if len(values) != len(self.columns):
+                    continue  # a value spanning lines; GenQuery offers no escaping
+                yield row_type(*[_convert(c, v) for c, v in zip(self.columns, values)])
+                count += 1
+                if self.max_rows is not None and count >= self.max_rows:
+                    return
+        except SessionException as e:
+            # iquest exits non-zero when nothing matches
+            if not no_rows and _NO_ROWS not in _text(e.stderr):
+                raise
+        finally:
+            proc.close()
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        for row in self.limit(1):
+            return row
+        return None
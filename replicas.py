@@ -0,0 +1,166 @@
+"""
+Latency-aware replica selection for reads.
+
+Left to itself, iget reads whichever replica the server picks, even when another resource holding a
+good copy is much closer.  With IRODS_REPLICA_SELECTION on, reads first list the object's replicas
+with one GenQuery, then ask for the replica on the resource expected to deliver it soonest (``iget -n``).
+How fast each resource is gets learned from the reads this process makes, as exponentially weighted
+averages; resources that haven't been read from yet are tried first, so each gets measured.
+A resource whose read fails is avoided for IRODS_REPLICA_COOLDOWN seconds and the read falls back to
+the next replica.
+
+    selector = replicas.selector()
+    data = selector.read(session, path, lambda options: session.run('iget', None, *(options + [path, '-']))[0])
+
+Streamed reads can't change replica once bytes have gone to the client, so they only get the choice
+of replica.  They go at the pace the client reads, which says nothing about the resource, so only their
+time to first byte is learned from them (see ReplicaSelector.track); whole-object throughput comes from
+buffered reads alone.
+"""
+
+import posixpath
+import select
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from django_irods.icommands import SessionException, CircuitOpenException, AdmissionException
+from django_irods.query import Query
+
+ENABLED = getattr(settings, 'IRODS_REPLICA_SELECTION', False)
+COOLDOWN = getattr(settings, 'IRODS_REPLICA_COOLDOWN', 60)
+# transfers smaller than this say more about latency than throughput, and aren't learned from
+MIN_SAMPLE_BYTES = getattr(settings, 'IRODS_REPLICA_MIN_SAMPLE', 1024 * 1024)
+_SMOOTHING = 0.3
+
+Replica = namedtuple('Replica', ['number', 'resource', 'size'])
+
+
+def list_replicas(session, path):
+    """The good (up to date) replicas of a data object, from a single query."""
+    coll, name = posixpath.split(path)
+    rows = Query(session, 'DATA_REPL_NUM', 'DATA_RESC_NAME', 'DATA_SIZE', 'DATA_REPL_STATUS') \
+        .filter('COLL_NAME', '=', coll) \
+        .filter('DATA_NAME', '=', name)
+    return [Replica(row.data_repl_num, row.data_resc_name, row.data_size) for row in rows if row.data_repl_status == 1]
+
+
+class ReplicaSelector(object):
+    def __init__(self, cooldown=COOLDOWN, min_sample=MIN_SAMPLE_BYTES):
+        self.cooldown = cooldown
+        self.min_sample = min_sample
+        self.throughput = {}  # resource name -> bytes per second
+        self.first_byte = {}  # resource name -> seconds until a streamed read's first byte
+        self.failed_at = {}   # resource name -> time of its last failed read
+        self._lock = threading.Lock()
+
+    def rank(self, replicas):
+        """
+        Order replicas best first: healthy resources before ones in their cooldown, then unmeasured resources, then
+        by the expected time to read them: time to first byte plus size over throughput, as far as they are known.
+        """
+        now = time.time()
+        with self._lock:
+            def key(replica):
+                cooling = now - self.failed_at.get(replica.resource, 0) < self.cooldown
+                rate = self.throughput.get(replica.resource)
+                first_byte = self.first_byte.get(replica.resource)
+                if rate is None and first_byte is None:
+                    return cooling, False, 0
+                seconds = (first_byte or 0) + ((replica.size or 0) / rate if rate else 0)
+                return cooling, True, seconds
+            return sorted(replicas, key=key)
+
+    def _learn(self, averages, resource, value):
+        previous = averages.get(resource)
+        averages[resource] = value if previous is None else previous + _SMOOTHING * (value - previous)
+
+    def record(self, resource, nbytes, seconds):
+        """Learn from a successful read of nbytes from a resource."""
+        with self._lock:
+            self.failed_at.pop(resource, None)
+            if nbytes < self.min_sample or seconds <= 0:
+                return
+            self._learn(self.throughput, resource, nbytes / float(seconds))
+
+    def record_first_byte(self, resource, seconds):
+        """Learn from a successful streamed read whose first byte came after seconds."""
+        with self._lock:
+            self.failed_at.pop(resource, None)
+            self._learn(self.first_byte, resource, seconds)
+
+    def failed(self, resource):
+        with self._lock:
+            self.failed_at[resource] = time.time()
+
+    def choose(self, session, path):
+        """
+        :return: the best replica of a data object, or None if it couldn't be listed (the server then chooses)
+        """
+        try:
+            ranked = self.rank(list_replicas(session, path))
+        except SessionException:
+            return None
+        return ranked[0] if ranked else None
+
+    def read(self, session, path, attempt):
+        """
+        Read a data object from the best replica, falling back to the others in turn.
+        :param attempt: called with a list of extra iget options selecting a replica (empty when the server is to
+            choose); it performs the read and returns its result, raising SessionException if the read failed
+        :return: the result of the first successful attempt
+        """
+        try:
+            candidates = self.rank(list_replicas(session, path))
+        except SessionException:
+            candidates = []
+        if not candidates:
+            return attempt([])
+
+        for i, replica in enumerate(candidates):
+            started = time.time()
+            try:
+                result = attempt(['-n', str(replica.number)])
+            except (CircuitOpenException, AdmissionException):
+                raise  # the host, not the resource, is in trouble
+            except SessionException:
+                self.failed(replica.resource)
+                if i == len(candidates) - 1:
+                    raise
+                continue
+            self.record(replica.resource, replica.size or 0, time.time() - started)
+            return result
+
+    def track(self, proc, replica):
+        """
+        Learn from a streamed read of a replica: its time to first byte, once it has been read to the end without
+        error.  Waits for the first byte (or the end of a failed read), which the response would wait for anyway.
+        """
+        started = time.time()
+        select.select([proc.stdout], [], [])
+        first_byte = time.time() - started
+
+        def done(error):
+            if error is None:
+                self.record_first_byte(replica.resource, first_byte)
+            else:
+                self.failed(replica.resource)
+        proc.add_done_callback(done)
+        return proc
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def selector():
+    """The process-wide ReplicaSelector, or None if IRODS_REPLICA_SELECTION is off."""
+    global _selector
+    if not ENABLED:
+        return None
+    with _selector_lock:
+        if _selector is None:
+            _selector = ReplicaSelector()
+        return _selector
@@ -0,0 +1,150 @@
+"""
+Size-aware routing of the iRODS Celery tasks, and per-user fair shares within a lane.
+
+Tasks are sorted into lanes, each with its own queue (IRODS_TASK_QUEUES), so that a batch of huge
+transfers can't hold up thousands of quick metadata calls:
+
+* ``metadata``: everything that doesn't move data (imeta, ils, iquest, ...)
+* ``small``: transfers expected to move less than IRODS_BULK_THRESHOLD bytes
+* ``bulk``: bigger transfers, and transfers whose size can't be told in advance
+
+Transfer tasks declare ``lane = 'transfer'`` and an ``estimate_size`` method, which is asked for a
+cheap estimate (a local stat, or a single ils) once, when the task is sent.  The estimate travels with the
+task in its ``irods_size_estimate`` keyword argument, which the task removes before it runs, so neither the
+router nor the worker has to make it again.  Install the router with::
+
+    CELERY_ROUTES = ('django_irods.routing.IrodsRouter',)
+
+and run workers for each queue.  Tasks that read statistics the web processes log to a local file
+(prewarm_bags, tiering) declare ``web_host = True`` and are sent to IRODS_WEB_HOST_QUEUE instead when it
+is set; run a worker for that queue on the web host, since a worker elsewhere would find an empty log.
+
+Within a lane, IRODS_FAIR_SHARE gives each user a token bucket, e.g. ``{'bulk': (1.0, 10)}`` for one
+token a second up to a burst of ten.  A task costs one token per IRODS_FAIR_SHARE_UNIT bytes it is
+expected to move (at least one).  A task whose user has run out is sent again with a countdown until the
+bucket refills, keeping its id and retry count, so the worker goes on to other users' tasks instead of one
+tenant monopolising the lane.
+The buckets live in the Django cache named by IRODS_FAIR_SHARE_CACHE, shared by all workers.
+"""
+
+import time
+
+from django.conf import settings
+
+METADATA = 'metadata'
+SMALL = 'small'
+BULK = 'bulk'
+TRANSFER = 'transfer'
+
+QUEUES = getattr(settings, 'IRODS_TASK_QUEUES', {
+    METADATA: 'irods.metadata',
+    SMALL: 'irods.transfer',
+    BULK: 'irods.bulk',
+})
+BULK_THRESHOLD = getattr(settings, 'IRODS_BULK_THRESHOLD', 1024 ** 3)
+FAIR_SHARE = getattr(settings, 'IRODS_FAIR_SHARE', {})
+FAIR_SHARE_UNIT = getattr(settings, 'IRODS_FAIR_SHARE_UNIT', 100 * 1024 ** 2)
+WEB_HOST_QUEUE = getattr(settings, 'IRODS_WEB_HOST_QUEUE', None)
+
+# the keyword argument carrying a transfer task's size estimate from where it was sent to the worker
+ESTIMATE = 'irods_size_estimate'
+
+
+def lane(task, args=(), kwargs=None):
+    """
+    The lane a call of a task belongs in.
+    :param task: the task (class or instance)
+    :param kwargs: the call's keyword arguments; an estimate already made is taken from them
+    :return: (lane, the estimated number of bytes it will move or None)
+    """
+    if getattr(task, 'lane', METADATA) != TRANSFER:
+        return METADATA, None
+    if kwargs and ESTIMATE in kwargs:
+        size = kwargs[ESTIMATE]
+    else:
+        try:
+            size = task.estimate_size(*(args or ()), **(kwargs or {}))
+        except Exception:
+            size = None  # a failed estimate must never stop the task being sent
+    if size is None or size >= BULK_THRESHOLD:
+        return BULK, size
+    return SMALL, size
+
+
+def tenant(environment):
+    """Whose share a task comes out of: the RodsEnvironment it runs as, or 'default' for the global session."""
+    if environment is None:
+        return 'default'
+    return '%s' % (getattr(environment, 'pk', environment),)
+
+
+class IrodsRouter(object):
+    """A Celery router sending iRODS tasks to their lane's queue."""
+    def route_for_task(self, task, args=None, kwargs=None):
+        if not task.startswith('django_irods.tasks.'):
+            return None
+        from celery import current_app
+        try:
+            task_type = current_app.tasks[task]
+        except KeyError:
+            return None
+        if WEB_HOST_QUEUE and getattr(task_type, 'web_host', False):
+            return {'queue': WEB_HOST_QUEUE}
+        task_lane, _ = lane(task_type, args, kwargs)
+        queue = QUEUES.get(task_lane)
+        return {'queue': queue} if queue else None
+
+
+class FairShare(object):
+    def __init__(self, cache, rate, burst):
+        """
+        :param cache: the Django cache to keep the token buckets in
+        :param rate: tokens added to each user's bucket per second
+        :param burst: the most tokens a bucket holds
+        """
+        self.cache = cache
+        self.rate = float(rate)
+        self.burst = burst
+
+    def take(self, lane_name, user, cost=1):
+        """
+        Take cost tokens from a user's bucket.
+        :return: 0 if they were taken, otherwise the seconds until the bucket will hold enough
+        """
+        cost = min(cost, self.burst)  # a task bigger than the bucket waits for a full one
+        key = 'irods:share:{lane}:{user}'.format(lane=lane_name, user=user)
+        lock = key + ':lock'
+        # the cache has no compare-and-set, so updates to a bucket are serialised with a short-lived lock
+        for _ in range(50):
+            if self.cache.add(lock, 1, 5):
+                break
+            time.sleep(0.01)
+        else:
+            return 1.0
+        try:
+            now = time.time()
+            tokens, updated = self.cache.get(key) or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                self.cache.set(key, (tokens - cost, now), None)
+                return 0
+            self.cache.set(key, (tokens, now), None)
+            return (cost - tokens) / self.rate
+        finally:
+            self.cache.delete(lock)
+
+
+def fair_share(lane_name):
+    """The FairShare for a lane, or None if the lane doesn't have one."""
+    if lane_name not in FAIR_SHARE:
+        return None
+    from django.core.cache import caches
+    rate, burst = FAIR_SHARE[lane_name]
+    return FairShare(caches[getattr(settings, 'IRODS_FAIR_SHARE_CACHE', 'default')], rate, burst)
+
+
+def cost(size):
+    """Tokens a transfer of size bytes costs."""
+    if size is None:
+        return max(1, BULK_THRESHOLD // FAIR_SHARE_UNIT)
+    return max(1, size // FAIR_SHARE_UNIT)
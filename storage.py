@@ -1,13 +1,100 @@
 import os
+import base64
+import hashlib
+import json
+import posixpath
 from tempfile import NamedTemporaryFile
 
 from django.utils.deconstruct import deconstructible
 from django.conf import settings
 from django.core.files.storage import Storage
-from django.core.urlresolvers import reverse
+try:
+    from django.urls import reverse
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import reverse
 
 from django_irods import icommands
-from icommands import Session, GLOBAL_SESSION, GLOBAL_ENVIRONMENT, SessionException, IRodsEnv
+from django_irods import bagging
+from django_irods import writebehind
+from django_irods import replicas
+from django_irods import tiering
+from django_irods.metacache import MetadataCache
+from django_irods.query import Query
+from django_irods.icommands import Session, GLOBAL_SESSION, GLOBAL_ENVIRONMENT, SessionException, IRodsEnv
+
+
+class LocalChecksum(object):
+    """
+    Running digests of bytes on their way into iRODS.  Both MD5 and SHA-256 are kept so that
+    the local copy can be compared against whichever checksum scheme the server uses
+    (plain MD5 hex, or "sha2:" followed by a base64 SHA-256 digest).
+    """
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    @classmethod
+    def from_file(cls, path, chunk_size=65536):
+        digest = cls()
+        with open(path, 'rb') as f:
+            chunk = f.read(chunk_size)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(chunk_size)
+        return digest
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+
+    def matches(self, remote):
+        if not remote:
+            return False
+        if remote.startswith('sha2:'):
+            return remote[len('sha2:'):] == base64.b64encode(self.sha256.digest())
+        return remote == self.md5.hexdigest()
+
+
+def _take(rows, column, count):
+    """
+    Take up to count rows with distinct values of an ordered column (GenQuery returns a row per replica), and
+    report whether there were more.
+    """
+    taken = []
+    rows = iter(rows)
+    try:
+        for row in rows:
+            if taken and getattr(taken[-1], column) == getattr(row, column):
+                continue
+            if len(taken) == count:
+                return taken, True
+            taken.append(row)
+        return taken, False
+    finally:
+        rows.close()
+
+
+def _iso(timestamp):
+    return timestamp.isoformat() + 'Z' if timestamp else None
+
+
+def encode_cursor(phase, last):
+    return base64.urlsafe_b64encode(json.dumps([phase, last]))
+
+
+def decode_cursor(cursor):
+    """:raises ValueError: for a malformed cursor"""
+    if not cursor:
+        return 'c', None
+    try:
+        phase, last = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Malformed listing cursor")
+    if phase not in ('c', 'd'):
+        raise ValueError("Malformed listing cursor")
+    return phase, last
 
 
 @deconstructible
@@ -16,9 +103,17 @@ class IrodsStorage(Storage):
         self.session = GLOBAL_SESSION
         self.environment = GLOBAL_ENVIRONMENT
         icommands.ACTIVE_SESSION = self.session
+        # when set, uploads whose size and checksum already match the object in iRODS are skipped
+        self.skip_unchanged = getattr(settings, 'IRODS_SKIP_UNCHANGED_UPLOADS', False)
+        # exists/size/getAVU results shared across processes, None when IRODS_METADATA_CACHE is unset
+        self.metadata_cache = MetadataCache.from_settings()
+        self.write_behind = self._write_behind()
 
-    def set_user_session(self, username=None, password=None, host=settings.IRODS_HOST, port=settings.IRODS_PORT, def_res=None, zone=settings.IRODS_ZONE, userid=0, sessid='None'):
+    def set_user_session(self, username=None, password=None, host=settings.IRODS_HOST, port=settings.IRODS_PORT, def_res=None, zone=settings.IRODS_ZONE, userid=0, sessid='None', providers=None):
         homedir = "/"+zone+"/home/"+username
+        if providers is None and host == settings.IRODS_HOST:
+            # the configured zone: spread over its providers too, if several are listed
+            providers = getattr(settings, 'IRODS_PROVIDERS', None)
         userEnv = IRodsEnv(
                pk=userid,
                host=host,
@@ -28,26 +123,55 @@ class IrodsStorage(Storage):
                cwd=homedir,
                username=username,
                zone=zone,
-               auth=password
+               auth=password,
+               providers=providers
             )
         self.session = Session(session_id=sessid)
         self.environment = self.session.create_environment(myEnv=userEnv)
         self.session.run('iinit', None, self.environment.auth)
         icommands.ACTIVE_SESSION = self.session
+        self.write_behind = self._write_behind()
+
+    def _write_behind(self):
+        # saves are staged locally and uploaded in the background when IRODS_WRITE_BEHIND_DIR is set
+        directory = getattr(settings, 'IRODS_WRITE_BEHIND_DIR', None)
+        if not directory:
+            return None
+        return writebehind.for_storage(self, directory)
+
+    def _pending(self, name):
+        if self.write_behind is None:
+            return None
+        return self.write_behind.pending(self.absolute_path(name))
 
     def download(self, name):
         return self._open(name, mode='rb')
 
-    def runBagitRule(self, rule_name, input_path, input_resource):
+    def runBagitRule(self, rule_name, input_path, input_resource, delayed=False, collection=None):
         """
         run iRODS bagit rule which generated bag-releated files without bundling
         :param rule_name: the iRODS rule name to run
         :param input_path: input parameter to the rule that indicates the collection path to create bag for
         :param input_resource: input parameter to the rule that indicates the default resource to store generated bag files
-        :return: None
+        :param delayed: queue the rule on the server as a delayed rule instead of waiting for it to finish
+        :param collection: the collection the bag is built for, when it can't be read from input_path
+        :return: None, or a bagging.BagBuild handle to poll when delayed
         """
-        # SessionException will be raised from run() in icommands.py
-        self.session.run("irule", None, '-F', rule_name, input_path, input_resource)
+        if not delayed:
+            # SessionException will be raised from run() in icommands.py
+            self.session.run("irule", None, '-F', rule_name, input_path, input_resource)
+            return None
+
+        collection = self.absolute_path(collection or input_path.split('=', 1)[-1].strip('\'"'))
+        build = bagging.BagBuild(self.session, collection)
+        with open(rule_name) as f:
+            rule = bagging.delayed_rule(f.read())
+        with NamedTemporaryFile(suffix='.r') as f:
+            f.write(rule)
+            f.flush()
+            self.session.run("irule", None, '-F', f.name, input_path, input_resource,
+                             "*BAGCOLL='{coll}'".format(coll=collection), "*BAGTOKEN='{token}'".format(token=build.token))
+        return build
 
     def zipup(self, in_name, out_name):
         """
@@ -57,8 +181,83 @@ class IrodsStorage(Storage):
         :return: None
         """
         self.session.run("imkdir", None, '-p', out_name.rsplit('/',1)[0])
-        # SessionException will be raised from run() in icommands.py
-        self.session.run("ibun", None, '-cDzip', '-f', out_name, in_name)
+        cache_dir = getattr(settings, 'IRODS_BAG_CACHE_DIR', None)
+        if cache_dir:
+            bagging.IncrementalZip(self, cache_dir).build(in_name, out_name)
+        else:
+            # SessionException will be raised from run() in icommands.py
+            self.session.run("ibun", None, '-cDzip', '-f', out_name, in_name)
+        self._invalidate(out_name)
+
+    def absolute_path(self, name):
+        """
+        Resolve a path relative to the session's working collection, as the icommands do.
+        iquest only accepts absolute collection names.
+        """
+        if name.startswith('/') or self.environment is None:
+            return name
+        return posixpath.join(self.environment.cwd, name)
+
+    def _cache_key(self, op, name, *extra):
+        if self.metadata_cache is None:
+            return None
+        # different users may see different things at the same path
+        username = getattr(self.environment, 'username', '')
+        return self.metadata_cache.key(op, self.absolute_path(name), username, *extra)
+
+    def _invalidate(self, name):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(self.absolute_path(name))
+
+    def query(self, *columns):
+        """
+        Start a GenQuery over this storage's session; see django_irods.query.Query.
+        :param columns: GenQuery column names to select
+        """
+        return Query(self.session, *columns)
+
+    def find_collections(self, attName, attVal=None):
+        """
+        Find every collection carrying an AVU with a single query, e.g. find_collections('bag_modified', 'true').
+        :return: a generator of absolute collection names
+        """
+        for row in self.query('COLL_NAME').avu(attName, attVal):
+            yield row.coll_name
+
+    MEMBER_COLUMNS = ('COLL_NAME', 'DATA_NAME', 'DATA_SIZE', 'DATA_CHECKSUM', 'DATA_MODIFY_TIME')
+
+    def collection_members(self, name):
+        """
+        Fingerprint every data object under a collection with a single iquest.
+        :param name: the collection name
+        :return: dict mapping absolute data object paths to [size, checksum, modification time].  Both are kept,
+            since an edit leaves a registered checksum stale until ichksum is run again.  GenQuery returns a row per
+            replica; the most recently modified replica stands for the object.
+        """
+        coll = self.absolute_path(name).rstrip('/')
+        members = {}
+        for where in (self.query(*self.MEMBER_COLUMNS).filter('COLL_NAME', '=', coll),
+                      self.query(*self.MEMBER_COLUMNS).filter('COLL_NAME', 'like', coll + '/%')):
+            for row in where:
+                path = row.coll_name + '/' + row.data_name
+                member = [row.data_size, row.data_checksum or '',
+                          row.data_modify_time.isoformat() if row.data_modify_time else '']
+                if path not in members or (member[2], member[1]) > (members[path][2], members[path][1]):
+                    members[path] = member
+        return members
+
+    def empty_collections(self, name, members):
+        """
+        The collections under a collection, itself included, that hold neither data objects nor collections.
+        :param name: the collection name
+        :param members: its collection_members()
+        :return: sorted list of absolute collection paths
+        """
+        coll = self.absolute_path(name).rstrip('/')
+        collections = set(row.coll_name for row in self.query('COLL_NAME').filter('COLL_NAME', 'like', coll + '/%'))
+        collections.add(coll)
+        occupied = set(posixpath.dirname(path) for path in list(members) + list(collections))
+        return sorted(collections - occupied)
 
     def setAVU(self, name, attName, attVal, attUnit=None):
         """
@@ -78,6 +277,7 @@ class IrodsStorage(Storage):
             self.session.run("imeta", None, 'set', '-C', name, attName, attVal, attUnit)
         else:
             self.session.run("imeta", None, 'set', '-C', name, attName, attVal)
+        self._invalidate(name)
 
     def getAVU(self, name, attName):
         """
@@ -92,14 +292,22 @@ class IrodsStorage(Storage):
         attUnit: the attribute Unit to set, default is None, but can be set to indicate additional info
         """
 
+        key = self._cache_key('avu', name, attName)
+        cached = key and self.metadata_cache.get(key)
+        if cached:
+            return cached[0]
+
         # SessionException will be raised from run() in icommands.py
         stdout = self.session.run("imeta", None, 'ls', '-C', name, attName)[0].split("\n")
         ret_att = stdout[1].strip()
         if ret_att == 'None': # queried attribute does not exist
-            return None
+            value = None
         else:
             vals = stdout[2].split(":")
-            return vals[1].strip()
+            value = vals[1].strip()
+        if key:
+            self.metadata_cache.set(key, value)
+        return value
 
     def copyFiles(self, src_name, dest_name):
         """
@@ -112,6 +320,7 @@ class IrodsStorage(Storage):
 
         if src_name and dest_name:
             self.session.run("icp", None, '-rf', src_name, dest_name)
+            self._invalidate(dest_name)
         return
 
     def saveFile(self, from_name, to_name, create_directory = False):
@@ -130,40 +339,181 @@ class IrodsStorage(Storage):
             if len(splitstrs) <= 1:
                 return
         if from_name:
+            if self.skip_unchanged and self.unchanged(to_name, LocalChecksum.from_file(from_name)):
+                return
+            options = self._iput_options()
             try:
-                self.session.run("iput", None, '-f', from_name, to_name)
+                self.session.run("iput", None, options, from_name, to_name)
             except:
-                self.session.run("iput", None, '-f', from_name, to_name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
+                self.session.run("iput", None, options, from_name, to_name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
+            self._invalidate(to_name)
         return
 
+    def _iput_options(self):
+        # register a checksum on upload so that later unchanged() checks don't make the server compute one
+        return '-fk' if self.skip_unchanged else '-f'
+
+    def checksum(self, name):
+        """
+        Return the checksum registered for a data object, having the server compute and register one
+        if the object doesn't have one yet.
+        :param name: the data object path in iRODS
+        :return: the checksum string as reported by ichksum, e.g. "sha2:..." or an MD5 hex digest
+        """
+        stdout = self.session.run("ichksum", None, name)[0].split("\n")
+        for line in stdout:
+            # "<name> <checksum>": the name may hold spaces, the checksum never does
+            fields = line.strip().rsplit(None, 1)
+            if len(fields) == 2 and not line.startswith('Total'):
+                return fields[1]
+        return None
+
+    def unchanged(self, name, local):
+        """
+        Check whether the data object already holds the bytes described by a LocalChecksum.
+        Sizes are compared first so that a checksum is only fetched when it could possibly match.
+        :param name: the data object path in iRODS
+        :param local: a LocalChecksum of the content about to be uploaded
+        :return: True if the upload can be skipped
+        """
+        try:
+            if self.size(name) != local.size:
+                return False
+            return local.matches(self.checksum(name))
+        except (SessionException, IndexError, ValueError):
+            return False
+
+    def sync(self, local_dir, collection):
+        """
+        Synchronize a local directory into an iRODS collection with irsync, which only transfers files
+        whose size or checksum differ from what is already in the collection.
+        :param local_dir: the local directory to upload from
+        :param collection: the iRODS collection to upload to, created if necessary
+        :return: stdout, stderr of the irsync command
+        """
+        self.session.run("imkdir", None, '-p', collection)
+        try:
+            return self.session.run("irsync", None, '-rK', local_dir, 'i:' + collection)
+        finally:
+            self._invalidate(collection)
+
     def _open(self, name, mode='rb'):
+        staged = self._pending(name)
+        if staged:
+            try:
+                return open(staged, 'rb')
+            except IOError:
+                pass  # uploaded in the meantime
+        tiering.record_access(self.absolute_path(name))
         tmp = NamedTemporaryFile()
-        self.session.run("iget", None, '-f', name, tmp.name)
-        return tmp
+
+        def fetch(replica_options):
+            self.session.run("iget", None, *(replica_options + ['-f', name, tmp.name]))
+            return tmp
+        selector = replicas.selector()
+        return selector.read(self.session, self.absolute_path(name), fetch) if selector else fetch([])
 
     def _save(self, name, content):
-        self.session.run("imkdir", None, '-p', name.rsplit('/',1)[0])
+        if self.write_behind is not None:
+            self.write_behind.stage(self.absolute_path(name), content)
+            return name
+        # only hash the upload when it may be skipped
+        local = LocalChecksum() if self.skip_unchanged else None
         with NamedTemporaryFile(delete=False) as f:
             for chunk in content.chunks():
                 f.write(chunk)
+                if local is not None:
+                    local.update(chunk)
             f.flush()
             f.close()
+            if self.skip_unchanged and self.unchanged(name, local):
+                os.unlink(f.name)
+                return name
+            self.session.run("imkdir", None, '-p', name.rsplit('/',1)[0])
+            options = self._iput_options()
             try:
-                self.session.run("iput", None, '-f', f.name, name)
+                self.session.run("iput", None, options, f.name, name)
             except:
-                self.session.run("iput", None, '-f', f.name, name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
+                self.session.run("iput", None, options, f.name, name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
             os.unlink(f.name)
+            self._invalidate(name)
         return name
 
+    def _discard_pending(self, name):
+        """Drop staged saves of name before it is deleted, waiting out an upload already under way."""
+        if self.write_behind is not None and not self.write_behind.discard(self.absolute_path(name)):
+            raise SessionException(-1, '', "An upload of {name} is still in progress".format(name=name))
+
     def delete(self, name):
-        self.session.run("irm", None, "-rf", name)
+        self._discard_pending(name)
+        try:
+            self.session.run("irm", None, "-rf", name)
+        finally:
+            self._invalidate(name)
+
+    def delete_many(self, names, trash=False):
+        """
+        Delete many data objects or collections with as few irm calls as possible.
+        :param names: the paths to delete
+        :param trash: move them into the trash, to be purged later (see django_irods.trash), instead of removing
+            them outright
+        :return: dict mapping the paths that couldn't be deleted to irm's error message
+        """
+        options = ('-r',) if trash else ('-rf',)
+        max_count = getattr(settings, 'IRODS_DELETE_BATCH', 200)
+        max_bytes = getattr(settings, 'IRODS_DELETE_ARGV_BYTES', 64 * 1024)
+        batches, batch, size = [], [], 0
+        for name in names:
+            if batch and (len(batch) >= max_count or size + len(name) + 1 > max_bytes):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(name)
+            size += len(name) + 1
+        if batch:
+            batches.append(batch)
+
+        failed = {}
+        for batch in batches:
+            for name in list(batch):
+                try:
+                    self._discard_pending(name)
+                except SessionException as e:
+                    failed[name] = e.stderr
+                    batch.remove(name)
+            if not batch:
+                continue
+            try:
+                self.session.run("irm", None, *(options + tuple(batch)))
+            except SessionException:
+                # irm gives up at the first path it can't remove, so go through the batch one by one to find it
+                for name in batch:
+                    try:
+                        self.session.run("irm", None, *(options + (name,)))
+                    except SessionException as e:
+                        # paths removed before the batch failed are gone now, which is what was asked for
+                        if 'does not exist' not in e.stderr:
+                            failed[name] = e.stderr.strip()
+            finally:
+                for name in batch:
+                    self._invalidate(name)
+        return failed
 
     def exists(self, name):
+        if self._pending(name):
+            return True
+        key = self._cache_key('exists', name)
+        if key and self.metadata_cache.get(key):
+            return True
         try:
             stdout = self.session.run("ils", None, name)[0]
-            return stdout != ""
         except SessionException:
             return False
+        # only positive results are cached: imkdir -p and icp can bring paths into existence
+        # without going through a write that would invalidate them
+        found = stdout != ""
+        if found and key:
+            self.metadata_cache.set(key, True)
+        return found
 
     def listdir(self, path):
         stdout = self.session.run("ils", None, path)[0].split("\n")
@@ -177,9 +527,88 @@ class IrodsStorage(Storage):
                 listing[1].append(stdout[i].strip)
         return listing
 
+    def listing_etag(self, path, cursor=None, page_size=100):
+        """A validator for a page of listing(), which changes when the collection does; None without a metadata cache."""
+        if self.metadata_cache is None:
+            return None
+        username = getattr(self.environment, 'username', '')
+        key = self.metadata_cache.listing_key(self.absolute_path(path).rstrip('/') or '/', username, cursor, page_size)
+        return '"' + key.rsplit(':', 1)[-1] + '"'
+
+    def listing(self, path, cursor=None, page_size=100):
+        """
+        List one page of a collection: sub-collections first, then data objects, each in name order.  Pages are
+        fetched with keyset-paged iquest queries, so deep pages of huge collections cost the same as the first.
+        :param path: the collection to list
+        :param cursor: the next_cursor of the previous page, or None for the first page
+        :param page_size: the maximum number of entries to return
+        :return: dict with the absolute collection name, its entries (name, type, size and modified time) and
+            next_cursor, which is None on the last page
+        :raises ValueError: for a malformed cursor
+        """
+        coll = self.absolute_path(path).rstrip('/') or '/'
+        key = None
+        if self.metadata_cache is not None:
+            username = getattr(self.environment, 'username', '')
+            key = self.metadata_cache.listing_key(coll, username, cursor, page_size)
+            cached = self.metadata_cache.get(key)
+            if cached:
+                return cached[0]
+
+        phase, last = decode_cursor(cursor)
+        entries = []
+        next_cursor = None
+        if phase == 'c':
+            colls, more = _take(
+                self.query('COLL_NAME', 'COLL_MODIFY_TIME').filter('COLL_PARENT_NAME', '=', coll)
+                    .order_by('COLL_NAME').after('COLL_NAME', last),
+                'coll_name', page_size)
+            entries.extend({
+                'name': posixpath.basename(row.coll_name),
+                'type': 'collection',
+                'size': None,
+                'modified': _iso(row.coll_modify_time),
+            } for row in colls if row.coll_name != coll)
+            if more:
+                next_cursor = encode_cursor('c', colls[-1].coll_name)
+            else:
+                phase, last = 'd', None
+
+        if phase == 'd' and next_cursor is None:
+            objs, more = _take(
+                self.query('DATA_NAME', 'DATA_SIZE', 'DATA_MODIFY_TIME').filter('COLL_NAME', '=', coll)
+                    .order_by('DATA_NAME').after('DATA_NAME', last),
+                'data_name', page_size - len(entries))
+            entries.extend({
+                'name': row.data_name,
+                'type': 'data_object',
+                'size': row.data_size,
+                'modified': _iso(row.data_modify_time),
+            } for row in objs)
+            if more:
+                next_cursor = encode_cursor('d', objs[-1].data_name if objs else last)
+
+        page = {'collection': coll, 'entries': entries, 'next_cursor': next_cursor}
+        if key:
+            self.metadata_cache.set(key, page)
+        return page
+
     def size(self, name):
+        staged = self._pending(name)
+        if staged:
+            try:
+                return os.path.getsize(staged)
+            except OSError:
+                pass  # uploaded in the meantime
+        key = self._cache_key('size', name)
+        cached = key and self.metadata_cache.get(key)
+        if cached:
+            return cached[0]
         stdout = self.session.run("ils", None, "-l", name)[0].split()
-        return int(stdout[3])
+        size = int(stdout[3])
+        if key:
+            self.metadata_cache.set(key, size)
+        return size
 
     def url(self, name):
         return reverse('django_irods.views.download', kwargs={'path': name})
@@ -43,10 +43,22 @@ what each does:
 
 from celery.task import Task
 from celery.task.sets import subtask
+from celery.exceptions import Retry
+import icommands
+import tracing
 from icommands import Session, GLOBAL_SESSION, IRodsEnv
 
 from . import models as m
+from .bagging import BagBuild
+from . import fixity
+from . import replicas
+from . import tiering
+from . import routing
+from . import prewarm
+from . import mounts
+from . import trash
 from uuid import uuid4
+import hashlib
 import os
 import tempfile
 import requests
@@ -58,12 +70,70 @@ class RodsException(Exception):
 
 class IRODSTask(Task):
     abstract=True
+    lane = routing.METADATA  # tasks that move data set this to routing.TRANSFER and implement estimate_size
+    web_host = False  # tasks reading a log kept on the web host set this, for routing.WEB_HOST_QUEUE
 
     def __init__(self, *args, **kwargs):
         super(IRODSTask, self).__init__(*args, **kwargs)
         self._sessions = {}
-        self._mounted_collections = {}
-        self._mounted_names = {}
+        self._mounts = {}
+
+    def estimate_size(self, environment=None, *args, **kwargs):
+        """The number of bytes a call is expected to move, or None if it can't be told cheaply."""
+        return None
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        # estimate a transfer's size once, here, and send the estimate along for the router and the worker
+        if self.lane == routing.TRANSFER and routing.ESTIMATE not in (kwargs or {}):
+            _, size = routing.lane(self, args, kwargs)
+            kwargs = dict(kwargs or {})
+            kwargs[routing.ESTIMATE] = size
+        return super(IRODSTask, self).apply_async(args, kwargs, **options)
+
+    def _take_share(self, args, kwargs):
+        if not routing.FAIR_SHARE or self.request.called_directly:
+            return
+        lane, size = routing.lane(self, args, kwargs)
+        share = routing.fair_share(lane)
+        if share is None:
+            return
+        environment = args[0] if args else kwargs.get('environment')
+        wait = share.take(lane, routing.tenant(environment), routing.cost(size))
+        if wait:
+            # not a failure: send the task again, under the same id and with the same retry count, for when its
+            # user's share has refilled.  self.retry() would count it as a retry and use up max_retries
+            options = {
+                'task_id': self.request.id,
+                'countdown': wait,
+                'retries': self.request.retries,
+                'link': self.request.callbacks,
+                'link_error': self.request.errbacks,
+            }
+            if routing.QUEUES.get(lane):
+                options['queue'] = routing.QUEUES[lane]
+            self.apply_async(args, kwargs, **options)
+            raise Retry('waiting for the fair share of {0}'.format(routing.tenant(environment)), when=wait)
+
+    def __call__(self, *args, **kwargs):
+        self._take_share(args, kwargs)
+        kwargs.pop(routing.ESTIMATE, None)
+        if not tracing.ENABLED:
+            return self._call_within_limit(*args, **kwargs)
+        with tracing.trace(self.name) as tracer:
+            try:
+                return self._call_within_limit(*args, **kwargs)
+            finally:
+                tracer.report()
+
+    def _call_within_limit(self, *args, **kwargs):
+        # keep icommands inside the soft time limit, so they are killed and raise
+        # SessionTimeoutException rather than being abandoned when the limit strikes
+        timelimit = getattr(self.request, 'timelimit', None)
+        soft_limit = (timelimit[1] if timelimit else None) or self.soft_time_limit
+        if soft_limit:
+            with icommands.deadline(soft_limit):
+                return super(IRODSTask, self).__call__(*args, **kwargs)
+        return super(IRODSTask, self).__call__(*args, **kwargs)
 
     def session(self, environment=None):
         if getattr(settings, 'IRODS_GLOBAL_SESSION', False):
@@ -79,7 +149,8 @@ class IRODSTask(Task):
                 cwd=settings.IRODS_CWD,
                 username=settings.IRODS_USERNAME,
                 zone=settings.IRODS_ZONE,
-                auth=settings.IRODS_AUTH
+                auth=settings.IRODS_AUTH,
+                providers=getattr(settings, 'IRODS_PROVIDERS', None)
             )
         elif isinstance(environment, int):
             environment = m.RodsEnvironment.objects.get(pk=environment)
@@ -93,30 +164,39 @@ class IRODSTask(Task):
 
         return self._sessions[environment.pk]
 
+    def _environment_key(self, environment):
+        if getattr(settings, 'IRODS_GLOBAL_SESSION', False) or environment is None:
+            return None
+        return getattr(environment, 'pk', environment)
+
     def mount(self, environment, local_name, collection=None):
-        if local_name not in self._mounted_collections:
-            if collection:
-                self.session(environment).run('icd', None, collection)
+        """
+        Mount a collection (the session's working collection by default) with irodsFs under a name, and return the
+        local path it is mounted at.  Mounts are shared by every task in the worker process (see django_irods.mounts).
+        """
+        if local_name not in self._mounts:
+            self._mounts[local_name] = mounts.manager().acquire(
+                self.session(environment), self._environment_key(environment), collection)
+        return self._mounts[local_name].path
 
-            path = os.path.join(self.session(environment).session_path, local_name)
-            os.mkdir(path)
-            self.session(environment).run('irodsFs', None, path)
-            self._mounted_collections[local_name] = collection
-            self._mounted_names[local_name] = path
-        return self._mounted_names[local_name]
+    def mounted(self, environment, collection=None):
+        """Context manager giving the local path of a mounted collection, to read data objects in place."""
+        return mounts.manager().mounted(self.session(environment), self._environment_key(environment), collection)
 
     def collection(self, name):
-        return self._mounted_names[name]
+        return self._mounts[name].path
 
     def unmount(self, local_name):
-        if not hasattr(self, '_mounted_collections'):
+        """Give up a mount made with mount(); it is unmounted once no task has used it for a while."""
+        if not hasattr(self, '_mounts'):
             return None
 
-        if local_name in self._mounted_collections:
-            os.system("fusermount -uz {local_name}".format(local_name=self.collection(local_name)))
+        mount = self._mounts.pop(local_name, None)
+        if mount is not None:
+            mounts.manager().release(mount)
 
     def __del__(self):
-        for name in self._mounted_names.keys():
+        for name in list(self._mounts.keys()):
             self.unmount(name)
         for session in self._sessions.values():
             session.run('iexit')
@@ -129,6 +209,13 @@ CHUNK_SIZE=8192
 
 class IGet(IRODSTask):
     name = 'django_irods.tasks.iget'
+    lane = routing.TRANSFER
+
+    def estimate_size(self, environment, path, *args, **kwargs):
+        if '-r' in args:
+            return None  # a collection: its size can't be told without listing all of it, so it goes in bulk
+        # raises if the path isn't a data object, which lane() takes as an unknown size
+        return int(self.session(environment).run('ils', None, '-l', path)[0].split()[3])
 
     def run(self, environment, path, callback=None, post=None, post_name=None, *options):
         """
@@ -202,13 +289,22 @@ class IGet(IRODSTask):
         """
 
         options += ('-',) # we're redirecting to stdout.
-
-        proc = self.session(environment).run_safe('iget', None, path, *options)
-        tmp = tempfile.SpooledTemporaryFile()   # spool to disk if the iget is too large
-        chunk = proc.stdout.read(CHUNK_SIZE)
-        while chunk:
-            tmp.write(chunk)
-            chunk = proc.stdout.read(CHUNK_SIZE)
+        session = self.session(environment)
+
+        def fetch(replica_options):
+            proc = session.stream('iget', None, *(replica_options + [path] + list(options)))
+            tmp = tempfile.SpooledTemporaryFile()   # spool to disk if the iget is too large
+            try:
+                chunk = proc.read(CHUNK_SIZE)
+                while chunk:
+                    tmp.write(chunk)
+                    chunk = proc.read(CHUNK_SIZE)
+            finally:
+                proc.close()
+            return tmp
+
+        selector = replicas.selector()
+        tmp = selector.read(session, path, fetch) if selector else fetch([])
 
         tmp.flush()
         tmp.seek(0)
@@ -228,6 +324,12 @@ class IGet(IRODSTask):
 
 class IPut(IRODSTask):
     name = 'django_irods.tasks.iput'
+    lane = routing.TRANSFER
+
+    def estimate_size(self, environment, data_is_file, path, data, *options):
+        if not data_is_file:
+            return len(data)
+        return None if os.path.isdir(data) else os.path.getsize(data)
 
     def run(self, environment, data_is_file, path, data, *options):
         """
@@ -486,10 +588,58 @@ class IBundle(IRODSTask):
        return self.session(environment).run('iadmin', None, command, *options)
 
 
+class WaitForBag(IRODSTask):
+    """
+    Completes once a bag build queued with IrodsStorage.runBagitRule(..., delayed=True) has finished on the
+    iRODS server, polling its completion marker between retries.  Use it in a chain or chord, or pass a
+    callback subtask to be called with the collection name.
+
+    :param environment: a dict or primary key of the RodsEnvironment model that governs this session
+    :param collection: the absolute path of the collection being bagged
+    :param token: the BagBuild token of the build to wait for
+    :param callback: an optional registered Celery task to call with the collection name
+    :return: the collection name
+    """
+    name = 'django_irods.tasks.wait_for_bag'
+    default_retry_delay = 10
+    max_retries = 360
+
+    def run(self, environment, collection, token, callback=None):
+        if not BagBuild(self.session(environment), collection, token).done():
+            raise self.retry()
+        if callback:
+            subtask(callback).delay(collection)
+        return collection
+
+
 class IChksum(IRODSTask):
     name = 'django_irods.tasks.ichksum'
 
 
+class FixityAudit(IRODSTask):
+    """
+    Verify the checksums of every data object under a collection with ichksum -K, IRODS_FIXITY_WORKERS at a
+    time (see django_irods.fixity).  Progress is checkpointed in IRODS_FIXITY_CHECKPOINT_DIR, so running the
+    task again for the same collection after it was interrupted resumes the audit.
+
+    :param environment: a dict or primary key of the RodsEnvironment model that governs this session
+    :param collection: the absolute path of the collection to audit
+    :param workers: the number of checksums to verify at once, if not IRODS_FIXITY_WORKERS
+    :param all_replicas: verify every replica rather than one
+    :return: the audit report: counts, mismatches, errors and throughput
+    """
+    name = 'django_irods.tasks.fixity_audit'
+    lane = routing.TRANSFER
+
+    def run(self, environment, collection, workers=None, all_replicas=False):
+        checkpoint_dir = getattr(settings, 'IRODS_FIXITY_CHECKPOINT_DIR', tempfile.gettempdir())
+        checkpoint = os.path.join(
+            checkpoint_dir, 'fixity-' + hashlib.sha1(collection.encode('utf-8')).hexdigest() + '.json')
+        audit = fixity.FixityAudit(self.session(environment), collection, checkpoint,
+                                   workers or fixity.WORKERS, all_replicas)
+        return audit.run()
+
+
 class Ichmod(IRODSTask):
     name = 'django_irods.tasks.ichmod'
 
@@ -538,10 +688,54 @@ class Iphybun(IRODSTask):
     name = 'django_irods.tasks.iphybun'
 
 
+class PrewarmBags(IRODSTask):
+    """
+    Rebuild the stale bags of the most downloaded resources ahead of demand, within the budget set by the
+    IRODS_PREWARM_* settings (see django_irods.prewarm).  Needs IRODS_BAG_ACCESS_LOG, which is local to the web
+    host, so it is sent to IRODS_WEB_HOST_QUEUE; schedule it periodically, e.g. with celery beat.
+
+    :return: the prewarm report: the resource ids rebuilt, skipped and failed, and the time and bytes spent
+    """
+    name = 'django_irods.tasks.prewarm_bags'
+    lane = routing.TRANSFER
+    web_host = True
+
+    def run(self):
+        from .storage import IrodsStorage
+        log = prewarm.download_log()
+        if log is None:
+            raise RodsException('IRODS_BAG_ACCESS_LOG must be set for prewarming bags')
+        return prewarm.BagPrewarmer(IrodsStorage(), log).run()
+
+
 class Iphymv(IRODSTask):
     name = 'django_irods.tasks.iphymv'
 
 
+class Tiering(IRODSTask):
+    """
+    Move frequently read objects onto IRODS_TIERING_HOT_RESOURCE and objects that have gone cold onto
+    IRODS_TIERING_COLD_RESOURCE with iphymv, using the access statistics in IRODS_ACCESS_LOG (see
+    django_irods.tiering).  Schedule it periodically, e.g. with celery beat; it is sent to IRODS_WEB_HOST_QUEUE,
+    for a worker sharing a host with the web processes that write the log.
+
+    :param environment: a dict or primary key of the RodsEnvironment model that governs this session
+    :param dry_run: only report what would be moved
+    :return: the tiering report: the paths planned for each tier, the number moved and any errors
+    """
+    name = 'django_irods.tasks.tiering'
+    lane = routing.TRANSFER
+    web_host = True
+
+    def run(self, environment=None, dry_run=False):
+        log = tiering.access_log()
+        if log is None:
+            raise RodsException('IRODS_ACCESS_LOG must be set for tiering')
+        job = tiering.Tiering(self.session(environment), log,
+                              settings.IRODS_TIERING_HOT_RESOURCE, settings.IRODS_TIERING_COLD_RESOURCE)
+        return job.run(dry_run)
+
+
 class Ips(IRODSTask):
     name = 'django_irods.tasks.ips'
 
@@ -579,7 +773,20 @@ class Irm(IRODSTask):
 
 
 class Irmtrash(IRODSTask):
+    """
+    Purge the session user's trash gradually, in batches with pauses between them, only inside
+    IRODS_TRASH_PURGE_WINDOW and at most IRODS_TRASH_PURGE_MAX objects a run (see django_irods.trash).
+    Schedule it periodically, e.g. with celery beat, so deletes made through the trash are cleaned up
+    off-peak.
+
+    :param environment: a dict or primary key of the RodsEnvironment model that governs this session
+    :return: the purge report: the number of objects purged, any errors, and whether the trash was emptied
+    """
     name = 'django_irods.tasks.irmtrash'
+    lane = routing.TRANSFER  # a long, catalog-heavy job: keep it out of the metadata lane
+
+    def run(self, environment=None):
+        return trash.TrashPurge(self.session(environment)).run()
 
 
 class Irsync(IRODSTask):
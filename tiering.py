@@ -0,0 +1,217 @@
+"""
+Hot/cold tiering of data objects between a fast resource and an archive resource, driven by access statistics.
+
+With IRODS_ACCESS_LOG naming a local SQLite file, downloads and IrodsStorage reads are counted per data object.
+Each object keeps a single decaying score (every access adds 1, and the score halves every
+IRODS_ACCESS_HALF_LIFE seconds) and the time of its last access, so the log stays one small row per object
+however often it is read.  Counts are buffered in memory and written every IRODS_ACCESS_FLUSH seconds.
+
+The tiering job (Tiering.run, or the tiering Celery task) then:
+
+* moves objects scoring at least IRODS_TIERING_HOT_SCORE onto IRODS_TIERING_HOT_RESOURCE, and
+* moves objects on the hot resource that haven't been read for IRODS_TIERING_COLD_AFTER seconds onto
+  IRODS_TIERING_COLD_RESOURCE,
+
+with ``iphymv`` in batches of IRODS_TIERING_BATCH objects, at most IRODS_TIERING_MAX_MOVES objects a run and
+IRODS_TIERING_PAUSE seconds between batches.  A dry run only reports what would move.  Objects on the hot
+resource with no recorded access are never demoted.
+
+The log is a local file, so the tiering job must run on the host whose web processes write it (set
+IRODS_WEB_HOST_QUEUE, see django_irods.routing); elsewhere it would find an empty log and do nothing.
+"""
+
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from django_irods.icommands import SessionException
+from django_irods.query import Query
+
+HALF_LIFE = getattr(settings, 'IRODS_ACCESS_HALF_LIFE', 7 * 24 * 3600)
+FLUSH_INTERVAL = getattr(settings, 'IRODS_ACCESS_FLUSH', 10)
+HOT_SCORE = getattr(settings, 'IRODS_TIERING_HOT_SCORE', 5.0)
+COLD_AFTER = getattr(settings, 'IRODS_TIERING_COLD_AFTER', 30 * 24 * 3600)
+BATCH_SIZE = getattr(settings, 'IRODS_TIERING_BATCH', 50)
+MAX_MOVES = getattr(settings, 'IRODS_TIERING_MAX_MOVES', 1000)
+PAUSE = getattr(settings, 'IRODS_TIERING_PAUSE', 1.0)
+
+
+def _decay(score, last, now, half_life=HALF_LIFE):
+    return score * 0.5 ** (max(now - last, 0) / float(half_life))
+
+
+class AccessLog(object):
+    def __init__(self, path, half_life=HALF_LIFE, flush_interval=FLUSH_INTERVAL):
+        """
+        :param path: the SQLite file to keep the statistics in, shared by every process on the host
+        """
+        self.path = path
+        self.half_life = half_life
+        self.flush_interval = flush_interval
+        self._pending = {}  # path -> [accesses, last access]
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS access ('
+                       'path TEXT PRIMARY KEY, score REAL NOT NULL, last REAL NOT NULL)')
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.create_function('decay', 3, lambda score, last, now: _decay(score, last, now, self.half_life))
+        return db
+
+    def record(self, path):
+        """Count an access to a data object, by absolute path."""
+        now = time.time()
+        with self._lock:
+            entry = self._pending.setdefault(path, [0, now])
+            entry[0] += 1
+            entry[1] = now
+            due = now - self._flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+        if not pending:
+            return
+        db = self._connect()
+        try:
+            with db:
+                db.executemany('INSERT OR IGNORE INTO access (path, score, last) VALUES (?, 0, ?)',
+                               [(path, last) for path, (_, last) in pending.items()])
+                db.executemany('UPDATE access SET score = decay(score, last, ?) + ?, last = ? WHERE path = ?',
+                               [(last, count, last, path) for path, (count, last) in pending.items()])
+        finally:
+            db.close()
+
+    def hottest(self, min_score, limit):
+        """:return: [(path, score now)] for objects scoring at least min_score, hottest first"""
+        now = time.time()
+        db = self._connect()
+        try:
+            return db.execute('SELECT path, decay(score, last, ?) AS s FROM access WHERE s >= ? ORDER BY s DESC LIMIT ?',
+                              (now, min_score, limit)).fetchall()
+        finally:
+            db.close()
+
+    def _lookup(self, column, paths, *params):
+        db = self._connect()
+        try:
+            found = {}
+            paths = list(paths)
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                found.update(db.execute('SELECT path, {column} FROM access WHERE path IN ({marks})'.format(
+                    column=column, marks=', '.join('?' * len(chunk))), params + tuple(chunk)).fetchall())
+            return found
+        finally:
+            db.close()
+
+    def last_access(self, paths):
+        """:return: dict of the last access time of those of paths that have been accessed"""
+        return self._lookup('last', paths)
+
+    def scores(self, paths):
+        """:return: dict of the current score of those of paths that have been accessed"""
+        return self._lookup('decay(score, last, ?)', paths, time.time())
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def access_log():
+    """The process-wide AccessLog, or None if IRODS_ACCESS_LOG isn't set."""
+    global _log
+    path = getattr(settings, 'IRODS_ACCESS_LOG', None)
+    if not path:
+        return None
+    with _log_lock:
+        if _log is None:
+            _log = AccessLog(path)
+        return _log
+
+
+def record_access(path):
+    """Count a read of a data object, if access statistics are being kept."""
+    log = access_log()
+    if log is not None:
+        log.record(path)
+
+
+class Tiering(object):
+    def __init__(self, session, log, hot_resource, cold_resource, hot_score=HOT_SCORE, cold_after=COLD_AFTER,
+                 batch_size=BATCH_SIZE, max_moves=MAX_MOVES, pause=PAUSE):
+        """
+        :param session: the icommands Session to query and move with
+        :param log: the AccessLog to decide from
+        :param hot_resource: the fast resource the working set should live on
+        :param cold_resource: the archive resource the rest should live on
+        """
+        self.session = session
+        self.log = log
+        self.hot_resource = hot_resource
+        self.cold_resource = cold_resource
+        self.hot_score = hot_score
+        self.cold_after = cold_after
+        self.batch_size = max(1, batch_size)
+        self.max_moves = max_moves
+        self.pause = pause
+
+    def on_hot_resource(self):
+        """:return: the absolute paths of the objects with a replica on the hot resource"""
+        rows = Query(self.session, 'COLL_NAME', 'DATA_NAME').filter('DATA_RESC_NAME', '=', self.hot_resource)
+        return set(row.coll_name + '/' + row.data_name for row in rows)
+
+    def plan(self):
+        """
+        :return: (to_hot, to_cold), the paths to move onto each resource, hottest and coldest first, together at most
+            max_moves
+        """
+        self.log.flush()
+        resident = self.on_hot_resource()
+        to_hot = [path for path, _ in self.log.hottest(self.hot_score, self.max_moves) if path not in resident]
+
+        # objects never seen in the log are left alone: a new log, or one written on another host, says nothing
+        # about whether they are in use
+        cutoff = time.time() - self.cold_after
+        last = self.log.last_access(resident)
+        stale = sorted((when, path) for path, when in last.items() if when < cutoff)
+        to_cold = [path for _, path in stale][:max(self.max_moves - len(to_hot), 0)]
+        return to_hot, to_cold
+
+    def _move(self, paths, resource, source, report):
+        for i in range(0, len(paths), self.batch_size):
+            if i:
+                time.sleep(self.pause)
+            batch = paths[i:i + self.batch_size]
+            options = ('-S', source, '-R', resource) if source else ('-R', resource)
+            try:
+                self.session.run('iphymv', None, *(options + tuple(batch)))
+                report['moved'] += len(batch)
+            except SessionException:
+                # iphymv stops at the first failure, so retry the batch an object at a time to find it
+                for path in batch:
+                    try:
+                        self.session.run('iphymv', None, *(options + (path,)))
+                        report['moved'] += 1
+                    except SessionException as e:
+                        report['errors'].append({'path': path, 'error': e.stderr.strip()})
+
+    def run(self, dry_run=False):
+        """
+        Move objects between the tiers.
+        :param dry_run: only report what would be moved
+        :return: dict with the paths planned for each tier ('to_hot', 'to_cold'), the number moved and the errors met
+        """
+        to_hot, to_cold = self.plan()
+        report = {'to_hot': to_hot, 'to_cold': to_cold, 'moved': 0, 'errors': [], 'dry_run': dry_run}
+        if not dry_run:
+            self._move(to_hot, self.hot_resource, None, report)
+            self._move(to_cold, self.cold_resource, self.hot_resource, report)
+        return report
@@ -0,0 +1,177 @@
+"""
+Tracing of the icommands run on behalf of a request or task, to make N+1 patterns visible.
+
+Inside a ``trace()`` block every Session call made by the thread is recorded with its arguments,
+duration and the application frames that made it.  When the block ends the trace is summarised:
+identical calls repeated IRODS_TRACE_REPEATS times or more (typically exists/getAVU/size in a loop),
+calls slower than IRODS_TRACE_SLOW_CALL seconds and traces making more than IRODS_TRACE_MAX_CALLS
+calls are flagged, and the summary is logged to the ``django_irods.tracing`` logger, as a warning if
+anything was flagged::
+
+    with tracing.trace('rebuild bags') as tracer:
+        ...
+    print(tracer.summary())
+
+IrodsTraceMiddleware traces each request and, with DEBUG on, also returns the summary in the
+IRODS_TRACE_HEADER response header.  IRODSTask traces each Celery task.  Both are enabled by
+IRODS_TRACE, which defaults to DEBUG.  Outside a trace, recording costs a single thread-local lookup.
+AsyncSession calls are not traced, since the thread-local trace can't follow coroutines.
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import Counter
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'IRODS_TRACE', getattr(settings, 'DEBUG', False))
+REPEATS = getattr(settings, 'IRODS_TRACE_REPEATS', 3)
+MAX_CALLS = getattr(settings, 'IRODS_TRACE_MAX_CALLS', 20)
+SLOW_CALL = getattr(settings, 'IRODS_TRACE_SLOW_CALL', 1.0)
+STACK_DEPTH = getattr(settings, 'IRODS_TRACE_STACK_DEPTH', 6)
+
+_local = threading.local()
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_INTERNAL = tuple(os.path.join(_HERE, name) for name in ('icommands.py', 'tracing.py', 'query.py', 'storage.py'))
+
+
+REDACTED = '***'
+
+
+def _secret_from(icommand, args):
+    """Index of the first password-bearing argument of a call, or None if it carries none."""
+    if icommand == 'iinit':
+        return 0
+    if icommand == 'iadmin' and args:
+        if args[0] in ('spass', 'dspass'):
+            return 1
+        if args[0] == 'moduser' and len(args) > 2 and args[2] == 'password':
+            return 3
+    return None
+
+
+def _redact(icommand, args):
+    """The arguments to record for a call, with passwords masked so they never reach the logs or headers."""
+    args = ['%s' % (arg,) for arg in args]
+    start = _secret_from(icommand, args)
+    if start is None:
+        return args
+    return args[:start] + [REDACTED] * (len(args) - start)
+
+
+def _caller_stack():
+    """The innermost application frames, leaving out the django_irods plumbing between them and the icommand."""
+    stack = [frame for frame in traceback.extract_stack()[:-1] if not os.path.abspath(frame[0]).startswith(_INTERNAL)]
+    return ['{0}:{1} in {2}'.format(*frame[:3]) for frame in stack[-STACK_DEPTH:]]
+
+
+class Call(object):
+    def __init__(self, icommand, args, stack):
+        self.icommand = icommand
+        self.args = tuple(_redact(icommand, args))
+        self.stack = stack
+        self.started = time.time()
+        self.duration = None  # None until the command has finished
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.time() - self.started
+
+    def __str__(self):
+        return ' '.join((self.icommand,) + self.args)
+
+
+class Tracer(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+        self.started = time.time()
+
+    def record(self, icommand, args):
+        call = Call(icommand, args, _caller_stack())
+        self.calls.append(call)
+        return call
+
+    def repeated(self):
+        """:return: [(call, count)] for identical calls made at least IRODS_TRACE_REPEATS times, most repeated first"""
+        counts = Counter(str(call) for call in self.calls)
+        first = {}
+        for call in self.calls:
+            first.setdefault(str(call), call)
+        return [(first[text], count) for text, count in counts.most_common() if count >= REPEATS]
+
+    def slow(self):
+        return [call for call in self.calls if call.duration is not None and call.duration >= SLOW_CALL]
+
+    def problems(self):
+        problems = []
+        if len(self.calls) > MAX_CALLS:
+            problems.append('{n} icommands (limit {limit})'.format(n=len(self.calls), limit=MAX_CALLS))
+        for call, count in self.repeated():
+            problems.append('{count}x "{call}" from {caller}'.format(
+                count=count, call=call, caller=call.stack[-1] if call.stack else '?'))
+        for call in self.slow():
+            problems.append('slow "{call}" ({duration:.2f}s) from {caller}'.format(
+                call=call, duration=call.duration, caller=call.stack[-1] if call.stack else '?'))
+        return problems
+
+    def summary(self):
+        """One line: call count, time spent in icommands, and what was flagged."""
+        spent = sum(call.duration for call in self.calls if call.duration is not None)
+        by_command = Counter(call.icommand for call in self.calls)
+        line = '{name}: {n} icommands in {spent:.3f}s ({commands})'.format(
+            name=self.name, n=len(self.calls), spent=spent,
+            commands=', '.join('{0}={1}'.format(*item) for item in sorted(by_command.items())))
+        problems = self.problems()
+        if problems:
+            line += '; ' + '; '.join(problems)
+        return line
+
+    def report(self):
+        """Log the summary, with the call stacks of flagged calls at debug level."""
+        if self.problems():
+            logger.warning(self.summary())
+            for call, count in self.repeated():
+                logger.debug('%s called %d times, first from:\n  %s', call, count, '\n  '.join(call.stack))
+        else:
+            logger.info(self.summary())
+
+
+class trace(object):
+    """Context manager recording the icommands this thread runs; nested traces are recorded by both."""
+    def __init__(self, name=''):
+        self.tracer = Tracer(name)
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'tracers', ())
+        _local.tracers = self._outer + (self.tracer,)
+        return self.tracer
+
+    def __exit__(self, *exc_info):
+        _local.tracers = self._outer
+        return False
+
+
+class _Calls(object):
+    def __init__(self, calls):
+        self.calls = calls
+
+    def finish(self):
+        for call in self.calls:
+            call.finish()
+
+
+def record(icommand, args):
+    """
+    Note the start of an icommand with every active tracer.
+    :return: an object whose finish() records the end of the command, or None if nothing is tracing
+    """
+    tracers = getattr(_local, 'tracers', None)
+    if not tracers:
+        return None
+    return _Calls([tracer.record(icommand, args) for tracer in tracers])
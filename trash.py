@@ -0,0 +1,115 @@
+"""
+Throttled purging of the iRODS trash.
+
+Deleting through the trash (``irm`` without -f) is cheap for the request doing it, but leaves the
+catalog work for later, and a single ``irmtrash`` over a big deleted resource can load the catalog
+for a long time.  TrashPurge empties a user's trash gradually instead: it lists the data objects in
+the trash a page at a time and removes them with ``irmtrash`` in batches of IRODS_TRASH_PURGE_BATCH,
+pausing IRODS_TRASH_PURGE_PAUSE seconds between batches, removing at most IRODS_TRASH_PURGE_MAX objects
+a run, and only inside the IRODS_TRASH_PURGE_WINDOW hours, e.g. ``(22, 6)`` for overnight.  Objects
+are left in the trash until they are IRODS_TRASH_PURGE_AGE seconds old, so accidental deletes can
+still be recovered.  Once no data objects are left, the empty collections are removed.
+
+Run it with the irmtrash Celery task, scheduled periodically.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from django_irods.icommands import SessionException
+from django_irods.query import Query
+
+BATCH_SIZE = getattr(settings, 'IRODS_TRASH_PURGE_BATCH', 100)
+PAUSE = getattr(settings, 'IRODS_TRASH_PURGE_PAUSE', 2.0)
+MAX_OBJECTS = getattr(settings, 'IRODS_TRASH_PURGE_MAX', 10000)
+WINDOW = getattr(settings, 'IRODS_TRASH_PURGE_WINDOW', None)
+MIN_AGE = getattr(settings, 'IRODS_TRASH_PURGE_AGE', 0)
+
+
+def in_window(window, now=None):
+    """Whether the local hour falls in a (start_hour, end_hour) window, which may wrap past midnight."""
+    if not window:
+        return True
+    hour = (now or datetime.now()).hour
+    start, end = window
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def trash_home(session):
+    """The trash collection of the session's user, e.g. /hydroZone/trash/home/proxy."""
+    with open(os.path.join(session.session_path, "irods_environment.json")) as envfile:
+        env = json.load(envfile)
+    return '/{zone}/trash/home/{user}'.format(zone=env['irods_zone_name'], user=env['irods_user_name'])
+
+
+class TrashPurge(object):
+    def __init__(self, session, batch_size=BATCH_SIZE, pause=PAUSE, max_objects=MAX_OBJECTS, window=WINDOW,
+                 min_age=MIN_AGE):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self.max_objects = max_objects
+        self.window = window
+        self.min_age = min_age
+
+    def _batches(self, trash):
+        # modify times are zero-padded seconds since the epoch, so they compare as strings
+        cutoff = '%011d' % int(time.time() - self.min_age)
+        query = Query(self.session, 'COLL_NAME', 'DATA_NAME') \
+            .filter('COLL_NAME', 'like', trash + '/%') \
+            .filter('DATA_MODIFY_TIME', '<', cutoff) \
+            .limit(self.batch_size)
+        # every batch is gone from the trash once it has been purged, so each page starts from the top again
+        while True:
+            batch = sorted(set(row.coll_name + '/' + row.data_name for row in query))
+            if not batch:
+                return
+            yield batch
+
+    def _purge(self, paths, report):
+        try:
+            self.session.run('irmtrash', None, *paths)
+            report['purged'] += len(paths)
+        except SessionException:
+            # find the objects that can't be purged, so they aren't listed again and again
+            for path in paths:
+                try:
+                    self.session.run('irmtrash', None, path)
+                    report['purged'] += 1
+                except SessionException as e:
+                    report['errors'].append({'path': path, 'error': e.stderr.strip()})
+
+    def run(self):
+        """
+        Purge the trash within the configured limits.
+        :return: dict with the number of objects purged, the errors met, and whether the trash was emptied
+        """
+        report = {'purged': 0, 'errors': [], 'emptied': False}
+        if not in_window(self.window):
+            return report
+        trash = trash_home(self.session)
+        for batch in self._batches(trash):
+            failed = set(error['path'] for error in report['errors'])
+            batch = [path for path in batch if path not in failed]
+            if not batch:
+                break  # only objects that can't be purged are left
+            if report['purged'] and self.pause:
+                time.sleep(self.pause)
+            self._purge(batch, report)
+            if report['purged'] >= self.max_objects or not in_window(self.window):
+                return report
+
+        if not report['errors'] and not self.min_age:
+            # only empty collections are left, which are cheap to remove in one go
+            try:
+                self.session.run('irmtrash', None, '-r', trash)
+                report['emptied'] = True
+            except SessionException as e:
+                report['errors'].append({'path': trash, 'error': e.stderr.strip()})
+        return report
@@ -5,5 +5,5 @@ urlpatterns = patterns('',
     # users API
 
     url(r'^download/(?P<path>.*)$', 'django_irods.views.download'),
-    url(r'^list/$', 'django_irods.views.list'),
+    url(r'^listing/$', 'django_irods.views.listing'),
 )
\ No newline at end of file
@@ -1,19 +1,94 @@
 # Create your views here.
 from uuid import uuid4
+import calendar
 import os
 import mimetypes
+import posixpath
+import urllib
 
 from rest_framework.decorators import api_view
 
 from django_irods import icommands
+from django_irods import fastpath
+from django_irods import replicas
+from django_irods import tiering
+from django_irods import bagging
+from django_irods import prewarm
+from django_irods import zipstream
+from django_irods import compression
+from django_irods.query import Query
 from django_irods.storage import IrodsStorage
 from django.conf import settings
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse, JsonResponse, HttpResponseBadRequest, \
+    HttpResponseNotModified, HttpResponseForbidden
+from django.utils.cache import patch_vary_headers
 
 from hs_core.views.utils import authorize, Action_To_Authorize
-from hs_core.hydroshare.hs_bagit import create_bag_by_irods
 from . import models as m
-from .icommands import Session, GLOBAL_SESSION
+from .icommands import Session, GLOBAL_SESSION, GLOBAL_ENVIRONMENT
+
+# largest page the listing endpoint will return
+MAX_LISTING_PAGE = getattr(settings, 'IRODS_MAX_LISTING_PAGE', 1000)
+
+
+def _modify_time(session, irods_path):
+    """The catalog modification time of a data object in seconds since the epoch (its newest replica's), or None."""
+    query = Query(session, 'DATA_MODIFY_TIME') \
+        .filter('COLL_NAME', '=', posixpath.dirname(irods_path)) \
+        .filter('DATA_NAME', '=', posixpath.basename(irods_path))
+    times = [row.data_modify_time for row in query if row.data_modify_time]
+    return calendar.timegm(max(times).utctimetuple()) if times else None
+
+
+def _local_copy(istorage, session, path, size):
+    """
+    Find a copy of a data object on the local filesystem that the front-end web server can send itself.
+    IRODS_LOCAL_ROOTS lists (irods_collection, local_directory, internal_url) triples for irodsFs mounts
+    and local caches; internal_url is the location used with X-Accel-Redirect and may be None for
+    X-Sendfile.  A copy whose size differs from the data object's, or that is older than the data object's
+    catalog modification time, is treated as stale.  irodsFs reports that time as the file's, and a cache
+    must keep its copies' times no older than when they were fetched.
+    :return: the value for the IRODS_SENDFILE_HEADER header, or None if the object isn't available locally
+    """
+    irods_path = istorage.absolute_path(path)
+    modified = False  # not looked up yet
+    for collection, local_dir, internal_url in getattr(settings, 'IRODS_LOCAL_ROOTS', ()):
+        prefix = collection.rstrip('/') + '/'
+        if not irods_path.startswith(prefix):
+            continue
+        relative = irods_path[len(prefix):]
+        local_path = os.path.join(local_dir, *relative.split('/'))
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            continue
+        if stat.st_size != size:
+            continue
+        if modified is False:
+            modified = _modify_time(session, irods_path)
+        if modified is None or int(stat.st_mtime) < modified:
+            continue
+        if internal_url:
+            return internal_url.rstrip('/') + '/' + urllib.quote(relative)
+        return local_path
+    return None
+
+
+def _session(kwargs):
+    """The session a request should use, and the environment it was created from."""
+    if 'environment' in kwargs:
+        environment = int(kwargs['environment'])
+        environment = m.RodsEnvironment.objects.get(pk=environment)
+        session = Session("/tmp/django_irods", settings.IRODS_ICOMMANDS_PATH, session_id=uuid4())
+        session.create_environment(environment)
+        session.run('iinit', None, environment.auth)
+        return session, environment
+    elif getattr(settings, 'IRODS_GLOBAL_SESSION', False):
+        return GLOBAL_SESSION, GLOBAL_ENVIRONMENT
+    elif icommands.ACTIVE_SESSION:
+        return icommands.ACTIVE_SESSION, None
+    else:
+        raise KeyError('settings must have IRODS_GLOBAL_SESSION set if there is no environment object')
 
 
 @api_view(['GET'])
@@ -31,18 +106,11 @@ def download(request, path, *args, **kwargs):
         response.content = "<h1>You do not have permission to download this resource!</h1>"
         return response
 
-    if 'environment' in kwargs:
-        environment = int(kwargs['environment'])
-        environment = m.RodsEnvironment.objects.get(pk=environment)
-        session = Session("/tmp/django_irods", settings.IRODS_ICOMMANDS_PATH, session_id=uuid4())
-        session.create_environment(environment)
-        session.run('iinit', None, environment.auth)
-    elif getattr(settings, 'IRODS_GLOBAL_SESSION', False):
-        session = GLOBAL_SESSION
-    elif icommands.ACTIVE_SESSION:
-        session = icommands.ACTIVE_SESSION
-    else:
-        raise KeyError('settings must have IRODS_GLOBAL_SESSION set if there is no environment object')
+    prewarm.record_download(res_id)
+    session, _ = _session(kwargs)
+
+    # bags can be assembled from the resource collection as they are sent instead of being zipped up in iRODS first
+    stream_bag = split_path_strs[0] == 'bags' and getattr(settings, 'IRODS_STREAM_BAGS', False)
 
     # do on-demand bag creation
     istorage = IrodsStorage()
@@ -52,9 +120,16 @@ def download(request, path, *args, **kwargs):
     if istorage.exists(res_id):
         bag_modified = istorage.getAVU(res_id, 'bag_modified')
     if bag_modified == "true":
-        create_bag_by_irods(res_id, istorage)
-        if istorage.exists(res_id):
-            istorage.setAVU(res_id, 'bag_modified', "false")
+        bagging.rebuild_bag(istorage, res_id, stream_bag)
+
+    if stream_bag:
+        members = istorage.collection_members(res_id)
+        root = istorage.absolute_path(res_id).rstrip('/').rsplit('/', 1)[0]
+        prefetch = getattr(settings, 'IRODS_ZIP_PREFETCH', 1)
+        response = StreamingHttpResponse(zipstream.stream_collection(session, members, root, prefetch),
+                                         content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=path.split('/')[-1])
+        return response
 
     # obtain mime_type to set content_type
     mtype = 'application-x/octet-stream'
@@ -62,32 +137,105 @@ def download(request, path, *args, **kwargs):
     if mime_type[0] is not None:
         mtype = mime_type[0]
 
+    tiering.record_access(istorage.absolute_path(path))
+
     # retrieve file size to set up Content-Length header
     stdout = session.run("ils", None, "-l", path)[0].split()
     flen = int(stdout[3])
 
-    options = ('-',) # we're redirecting to stdout.
-    proc = session.run_safe('iget', None, path, *options)
-    response = FileResponse(proc.stdout, content_type=mtype)
+    # hand the transfer to the web server when it can read the object itself, so no worker is tied up
+    sendfile_header = getattr(settings, 'IRODS_SENDFILE_HEADER', None)
+    if sendfile_header:
+        location = _local_copy(istorage, session, path, flen)
+        if location:
+            response = HttpResponse(content_type=mtype)
+            response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=path.split('/')[-1])
+            response[sendfile_header] = location
+            return response
+
+    # gzip text-like data as it streams when the client takes it, or send the compressed copy kept from last time
+    compressible = compression.compressible(mtype, flen)
+    compress = compressible and compression.accepts_gzip(request)
+    cache = compression.variant_cache() if compress else None
+    key = compression.variant_key(session, istorage.absolute_path(path), flen) if cache else None
+    cache = cache if key else None
+    cached = cache.get(key) if cache else None
+    if cached:
+        response = FileResponse(open(cached, 'rb'), content_type=mtype)
+        response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=path.split('/')[-1])
+        response['Content-Length'] = os.path.getsize(cached)
+        response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    # read from the replica on the resource that has been fastest, when there is a choice
+    selector = replicas.selector()
+    replica = selector.choose(session, istorage.absolute_path(path)) if selector else None
+    options = ('-n', str(replica.number)) if replica else ()
+    proc = session.stream('iget', None, *(options + (path, '-'))) # we're redirecting to stdout.
+    if replica:
+        selector.track(proc, replica)
+    fastpath.set_pipe_size(proc.stdout.fileno())
+    sock = fastpath.client_socket(request) if getattr(settings, 'IRODS_SPLICE_DOWNLOADS', False) else None
+    if compress:
+        response = StreamingHttpResponse(compression.GzipStream(proc, cache=cache, key=key), content_type=mtype)
+        response['Content-Encoding'] = 'gzip'
+    elif sock is not None and fastpath.can_splice():
+        # the kernel moves the bytes from iget's pipe to the client socket
+        response = StreamingHttpResponse(fastpath.SpliceStream(proc, sock), content_type=mtype)
+    else:
+        response = FileResponse(proc, content_type=mtype)
+        response.block_size = fastpath.BLOCK_SIZE
     response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=path.split('/')[-1])
-    response['Content-Length'] = flen
+    if not compress:
+        response['Content-Length'] = flen
+    if compressible:
+        patch_vary_headers(response, ('Accept-Encoding',))
     return response
 
 
-def list(request, *args, **kwargs):
-    if 'environment' in kwargs:
-        environment = int(kwargs['environment'])
-        environment = m.RodsEnvironment.objects.get(pk=environment)
-        session = Session("/tmp/django_irods", settings.IRODS_ICOMMANDS_PATH, session_id=uuid4())
-        session.create_environment(environment)
-        session.run('iinit', None, environment.auth)
-    elif getattr(settings, 'IRODS_GLOBAL_SESSION', False):
-        session = GLOBAL_SESSION
+def listing(request, *args, **kwargs):
+    """
+    JSON listing of a collection, a page at a time.  Query parameters: path (the collection, relative to
+    the working collection, which must be a resource collection or lie inside one), cursor (next_cursor from
+    the previous page) and page_size.  With a metadata cache configured, pages are cached and carry an ETag
+    that changes when the collection does.
+    """
+    session, environment = _session(kwargs)
+    istorage = IrodsStorage()
+    istorage.session = session
+    istorage.environment = environment or istorage.environment
+
+    # resource collections live directly in the working collection, named by resource id
+    if istorage.environment is not None:
+        working = istorage.environment.cwd
     else:
-        raise KeyError('settings must have IRODS_GLOBAL_SESSION set if there is no environment object')
+        working = session.run('ipwd', None)[0].strip()
+    path = posixpath.normpath(posixpath.join(working, request.GET.get('path', '')))
+    relative = posixpath.relpath(path, working)
+    res_id = relative.split('/')[0]
+    if relative == '.' or res_id in ('..', 'bags'):
+        return HttpResponseBadRequest('path must be inside a resource collection')
+    _, authorized, _ = authorize(request, res_id, needed_permission=Action_To_Authorize.VIEW_RESOURCE,
+                                 raises_exception=False)
+    if not authorized:
+        return HttpResponseForbidden('You do not have permission to list this resource')
+
+    cursor = request.GET.get('cursor') or None
+    try:
+        page_size = max(1, min(int(request.GET.get('page_size', 100)), MAX_LISTING_PAGE))
+    except ValueError:
+        return HttpResponseBadRequest('page_size must be an integer')
 
-    options = ('-',) # we're redirecting to stdout.
+    etag = istorage.listing_etag(path, cursor, page_size)
+    if etag and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
 
-    proc = session.run_safe('ils', None, *options)
-    response = HttpResponse(proc.stdout)
+    try:
+        page = istorage.listing(path, cursor, page_size)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    response = JsonResponse(page)
+    if etag:
+        response['ETag'] = etag
     return response
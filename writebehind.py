@@ -0,0 +1,320 @@
+"""
+Write-behind uploads for IrodsStorage.
+
+With IRODS_WRITE_BEHIND_DIR set, IrodsStorage._save stages the uploaded content in that directory,
+records it in a journal and returns without waiting for imkdir and iput.  Background drainer threads
+(IRODS_WRITE_BEHIND_WORKERS per process) then upload the staged files.  Until an upload has been
+committed, _open, exists and size answer from the staged copy.
+
+The journal is the staging directory itself, so it survives crashes: every save is written as a data
+file, fsynced, and only then made visible by atomically renaming its journal record into place.  A
+save is therefore either completely staged or absent.  Uploaders claim an entry by renaming its record,
+which only one thread or process can win.  Claims left by a process that died are released again, and
+an upload that fails goes back in the queue to be retried.  When a name is saved again before its
+earlier save has been uploaded, only the newest content is uploaded.
+
+The staging directory must be on a local filesystem shared by every process on the host that uses it.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+from uuid import uuid4
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WORKERS = getattr(settings, 'IRODS_WRITE_BEHIND_WORKERS', 2)
+RETRY_INTERVAL = getattr(settings, 'IRODS_WRITE_BEHIND_RETRY', 10)
+DISCARD_WAIT = getattr(settings, 'IRODS_WRITE_BEHIND_DISCARD_WAIT', 300)
+
+_RECORD = '.json'
+_DATA = '.data'
+_CLAIM = '.claim'
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WriteBehind(object):
+    def __init__(self, session, directory, metadata_cache=None, iput_options='-f', workers=WORKERS):
+        """
+        :param session: the icommands Session to upload with
+        :param directory: the staging directory for this session's user
+        :param metadata_cache: the MetadataCache to invalidate as uploads land, if any
+        :param iput_options: the options to upload with
+        :param workers: the number of uploads to run at once
+        """
+        self.session = session
+        self.directory = directory
+        self.metadata_cache = metadata_cache
+        self.iput_options = iput_options
+        self.workers = max(1, workers)
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another process created it first
+
+    def _entry_dir(self, name):
+        return os.path.join(self.directory, hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def stage(self, name, content):
+        """
+        Durably stage content for upload to name.
+        :param name: the absolute data object path in iRODS
+        :param content: a Django File to read the content from
+        """
+        entry_dir = self._entry_dir(name)
+        # sequence numbers sort in staging order, so the newest save of a name is always last
+        seq = '{0:020d}-{1}'.format(int(time.time() * 1000000), uuid4().hex[:8])
+        base = os.path.join(entry_dir, seq)
+        with self._create(entry_dir, base + _DATA) as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(base + '.tmp', 'w') as f:
+            json.dump({'name': name, 'staged': time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(base + '.tmp', base + _RECORD)
+        _fsync_dir(entry_dir)
+        self.start()
+        self._wake.set()
+
+    def _create(self, entry_dir, path):
+        """Create a file in a name's directory, which a drainer may be removing as empty at the same time."""
+        for _ in range(3):
+            try:
+                os.makedirs(entry_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                return open(path, 'wb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        raise IOError(errno.ENOENT, "Could not create staging file", path)
+
+    def _entries(self, entry_dir):
+        """:return: the sequence numbers of the entries in a name's directory, oldest first, and which are claimed"""
+        try:
+            files = os.listdir(entry_dir)
+        except OSError:
+            return [], {}
+        records = sorted(f[:-len(_RECORD)] for f in files if f.endswith(_RECORD))
+        claims = {}
+        for f in files:
+            if f.endswith(_CLAIM):
+                seq, pid = f[:-len(_CLAIM)].rsplit('.', 1)
+                claims[seq] = int(pid)
+        return records, claims
+
+    def pending(self, name):
+        """:return: the local path of the newest content staged for name and not yet uploaded, or None"""
+        entry_dir = self._entry_dir(name)
+        records, claims = self._entries(entry_dir)
+        staged = sorted(records + list(claims))
+        if not staged:
+            return None
+        return os.path.join(entry_dir, staged[-1] + _DATA)
+
+    def discard(self, name, timeout=DISCARD_WAIT):
+        """
+        Drop the saves of name, e.g. because it is being deleted.  Saves that haven't started uploading are
+        removed; an upload already under way is waited for, since it would otherwise land after the delete and
+        bring the object back.
+        :return: True once nothing is staged for name, False if an upload was still running after timeout seconds
+        """
+        entry_dir = self._entry_dir(name)
+        give_up = time.time() + timeout
+        while True:
+            records, claims = self._entries(entry_dir)
+            for seq in records:
+                self._remove(entry_dir, seq, _RECORD)
+            running = False
+            for seq, pid in claims.items():
+                if _alive(pid):
+                    running = True
+                else:
+                    self._remove(entry_dir, seq, '.{pid}{suffix}'.format(pid=pid, suffix=_CLAIM))
+            if not running:
+                # a failed upload puts its record back, so check again until nothing is left
+                if not self._entries(entry_dir)[0]:
+                    return True
+            elif time.time() >= give_up:
+                return False
+            else:
+                time.sleep(0.1)
+
+    def _remove(self, entry_dir, seq, suffix):
+        for path in (os.path.join(entry_dir, seq + suffix), os.path.join(entry_dir, seq + _DATA)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        try:
+            os.rmdir(entry_dir)  # only succeeds once nothing else is staged for the name
+        except OSError:
+            pass
+
+    def _claim(self, entry_dir, seq):
+        claim = os.path.join(entry_dir, '{seq}.{pid}{suffix}'.format(seq=seq, pid=os.getpid(), suffix=_CLAIM))
+        try:
+            os.rename(os.path.join(entry_dir, seq + _RECORD), claim)
+        except OSError:
+            return None  # somebody else claimed it
+        return claim
+
+    def _upload(self, entry_dir):
+        """
+        Upload the newest save staged in a name's directory, unless another uploader is already on it.
+        :return: True if an upload was committed
+        """
+        records, claims = self._entries(entry_dir)
+        for seq, pid in claims.items():
+            if _alive(pid):
+                return False
+            # the uploader died; put its entry back in the queue
+            try:
+                os.rename(os.path.join(entry_dir, '{seq}.{pid}{suffix}'.format(seq=seq, pid=pid, suffix=_CLAIM)),
+                          os.path.join(entry_dir, seq + _RECORD))
+            except OSError:
+                return False
+            records = sorted(records + [seq])
+        if not records:
+            return False
+
+        seq = records[-1]
+        claim = self._claim(entry_dir, seq)
+        if claim is None:
+            return False
+        try:
+            with open(claim) as f:
+                name = json.load(f)['name']
+            data = os.path.join(entry_dir, seq + _DATA)
+            self.session.run("imkdir", None, '-p', posixpath.dirname(name))
+            try:
+                self.session.run("iput", None, self.iput_options, data, name)
+            except:
+                self.session.run("iput", None, self.iput_options, data, name) # IRODS 4.0.2, sometimes iput fails on the first try.  A second try seems to fix it.
+        except Exception:
+            logger.exception("Write-behind upload from %s failed, will retry", entry_dir)
+            os.rename(claim, os.path.join(entry_dir, seq + _RECORD))
+            return False
+
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(name)
+        # older saves of the same name are superseded by the content just uploaded
+        for older in records[:-1]:
+            if self._claim(entry_dir, older):
+                self._remove(entry_dir, older, '.{pid}{suffix}'.format(pid=os.getpid(), suffix=_CLAIM))
+        self._remove(entry_dir, seq, '.{pid}{suffix}'.format(pid=os.getpid(), suffix=_CLAIM))
+        return True
+
+    def drain_once(self):
+        """
+        Make one pass over the staging directory, uploading what can be uploaded.
+        :return: the number of uploads committed
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        uploaded = 0
+        for entry in names:
+            entry_dir = os.path.join(self.directory, entry)
+            if os.path.isdir(entry_dir) and self._upload(entry_dir):
+                uploaded += 1
+        return uploaded
+
+    def _drain(self):
+        while True:
+            self._wake.clear()
+            try:
+                uploaded = self.drain_once()
+            except Exception:
+                logger.exception("Write-behind drainer pass over %s failed", self.directory)
+                uploaded = 0
+            if not uploaded:
+                self._wake.wait(RETRY_INTERVAL)
+
+    def start(self):
+        """Start the drainer threads, which also pick up whatever earlier processes left staged."""
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._drain)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def staged(self):
+        """:return: the number of names with saves that haven't been uploaded yet"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        staged = 0
+        for entry in names:
+            records, claims = self._entries(os.path.join(self.directory, entry))
+            if records or claims:
+                staged += 1
+        return staged
+
+    def flush(self, timeout=None):
+        """
+        Wait for everything staged to be uploaded, helping out in the calling thread.
+        :return: True if nothing is left staged, False if timeout seconds passed first
+        """
+        give_up = time.time() + timeout if timeout is not None else None
+        while self.staged():
+            if give_up is not None and time.time() >= give_up:
+                return False
+            if not self.drain_once():
+                time.sleep(0.1)
+        return True
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def for_storage(storage, directory):
+    """
+    The WriteBehind queue a storage should stage its saves in: one per user and process, whose drainers start
+    with it so that saves left by an earlier process are uploaded.
+    """
+    username = getattr(storage.environment, 'username', '') or 'default'
+    key = (directory, username)
+    with _queues_lock:
+        if key not in _queues:
+            _queues[key] = WriteBehind(storage.session, os.path.join(directory, username),
+                                       storage.metadata_cache, storage._iput_options())
+            _queues[key].start()
+        return _queues[key]
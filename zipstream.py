@@ -0,0 +1,177 @@
+"""
+Zip archives written as a stream, for responses that can't seek back to patch entry headers.
+
+Every entry is written with a trailing data descriptor, so sizes and CRCs are only needed once
+the entry's data has gone out.  ZIP64 records are emitted whenever a size, offset or entry count
+outgrows the classic format.
+"""
+
+import os
+import struct
+import time
+import zlib
+
+from django.conf import settings
+
+CHUNK_SIZE = 65536
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+ZIP32_LIMIT = 0xffffffff
+ZIP_COUNT_LIMIT = 0xffff
+
+_UTF8_FLAG = 0x800
+_DESCRIPTOR_FLAG = 0x08
+
+# members with these extensions are already compressed and are stored rather than deflated
+STORED_EXTENSIONS = getattr(settings, 'IRODS_ZIP_STORED_EXTENSIONS', (
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jpg', '.jpeg', '.png', '.gif',
+    '.mp3', '.mp4', '.avi', '.mov', '.nc', '.h5', '.hdf5', '.tif', '.tiff',
+))
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    dosdate = (max(t.tm_year, 1980) - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | (t.tm_sec // 2)
+    return dosdate, dostime
+
+
+class _Entry(object):
+    def __init__(self, name, method, zip64, offset, modified):
+        self.name = name
+        self.method = method
+        self.zip64 = zip64
+        self.offset = offset
+        self.dosdate, self.dostime = _dos_datetime(modified)
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+    @property
+    def flags(self):
+        return _DESCRIPTOR_FLAG | _UTF8_FLAG
+
+
+class ZipStream(object):
+    """
+    Produces the bytes of a zip archive one member at a time.  Feed members with member(), which
+    yields the entry's bytes as its content is consumed, and finish with close(), which yields the
+    central directory.
+    """
+    def __init__(self):
+        self.entries = []
+        self.offset = 0
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def member(self, name, chunks, size_hint=0, compress=True, modified=None):
+        """
+        :param name: the name of the entry in the archive
+        :param chunks: an iterable of the entry's content
+        :param size_hint: the expected size of the content, used to decide up front whether ZIP64 is needed
+        :param compress: deflate the content if True, store it as-is otherwise
+        :param modified: modification timestamp of the entry, defaults to now
+        :return: a generator of archive bytes
+        """
+        name = name.encode('utf-8') if not isinstance(name, bytes) else name
+        entry = _Entry(name, ZIP_DEFLATED if compress else ZIP_STORED,
+                       size_hint >= ZIP32_LIMIT or self.offset >= ZIP32_LIMIT,
+                       self.offset, modified or time.time())
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if entry.zip64 else b''
+        sizes = ZIP32_LIMIT if entry.zip64 else 0
+        yield self._out(struct.pack(
+            '<4s2B4HL2L2H', b'PK\003\004', entry.version, 0, entry.flags, entry.method,
+            entry.dostime, entry.dosdate, 0, sizes, sizes, len(name), len(extra)
+        ) + name + extra)
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if compress else None
+        for chunk in chunks:
+            if not chunk:
+                continue
+            entry.file_size += len(chunk)
+            entry.crc = zlib.crc32(chunk, entry.crc)
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            entry.compress_size += len(chunk)
+            yield self._out(chunk)
+        if compressor:
+            tail = compressor.flush()
+            entry.compress_size += len(tail)
+            yield self._out(tail)
+
+        entry.crc &= 0xffffffff
+        if entry.file_size >= ZIP32_LIMIT and not entry.zip64:
+            raise ValueError("{name} outgrew its size hint and needs ZIP64".format(name=name))
+        fmt = '<4sLQQ' if entry.zip64 else '<4sLLL'
+        yield self._out(struct.pack(fmt, b'PK\007\010', entry.crc, entry.compress_size, entry.file_size))
+        self.entries.append(entry)
+
+    def close(self):
+        """:return: a generator of the central directory bytes that end the archive"""
+        start = self.offset
+        for entry in self.entries:
+            overflow = [v for v in (entry.file_size, entry.compress_size, entry.offset) if v >= ZIP32_LIMIT]
+            extra = struct.pack('<HH', 1, 8 * len(overflow)) + struct.pack('<%dQ' % len(overflow), *overflow) if overflow else b''
+            yield self._out(struct.pack(
+                '<4s4B4HL2L5H2L', b'PK\001\002', 45 if overflow else 20, 3, 45 if overflow else entry.version, 0,
+                entry.flags, entry.method, entry.dostime, entry.dosdate, entry.crc,
+                min(entry.compress_size, ZIP32_LIMIT), min(entry.file_size, ZIP32_LIMIT),
+                len(entry.name), len(extra), 0, 0, 0, 0o100644 << 16, min(entry.offset, ZIP32_LIMIT)
+            ) + entry.name + extra)
+
+        size = self.offset - start
+        count = len(self.entries)
+        if count >= ZIP_COUNT_LIMIT or size >= ZIP32_LIMIT or start >= ZIP32_LIMIT:
+            zip64_end = self.offset
+            yield self._out(struct.pack('<4sQ2H2L4Q', b'PK\006\006', 44, 45, 45, 0, 0, count, count, size, start))
+            yield self._out(struct.pack('<4sLQL', b'PK\006\007', 0, zip64_end, 1))
+        yield self._out(struct.pack(
+            '<4s4H2LH', b'PK\005\006', 0, 0, min(count, ZIP_COUNT_LIMIT), min(count, ZIP_COUNT_LIMIT),
+            min(size, ZIP32_LIMIT), min(start, ZIP32_LIMIT), 0
+        ))
+
+
+def stream_collection(session, members, root, prefetch=1):
+    """
+    Stream a zip of collection members, fetching each with ``iget -``.  The next ``prefetch`` igets are
+    started while the current member streams, so their connection setup overlaps with the transfer;
+    each can only run ahead by one pipe buffer before it blocks.  A member whose iget fails raises
+    SessionException, which aborts the response rather than sending a truncated entry.
+    :param session: the icommands Session to fetch members with
+    :param members: dict mapping absolute data object paths to [size, checksum, modification time], as returned by
+        IrodsStorage.collection_members
+    :param root: the collection that entry names are made relative to
+    :param prefetch: how many members to start fetching ahead of the one being streamed
+    :return: a generator of zip archive bytes
+    """
+    root = root.rstrip('/') + '/'
+    paths = sorted(members)
+    started = []
+    zf = ZipStream()
+    try:
+        for i, path in enumerate(paths):
+            while len(started) <= min(prefetch, len(paths) - i - 1):
+                started.append(session.stream('iget', None, paths[i + len(started)], '-'))
+            proc = started.pop(0)
+            name = path[len(root):] if path.startswith(root) else path.lstrip('/')
+            compress = os.path.splitext(path)[1].lower() not in STORED_EXTENSIONS
+            try:
+                for data in zf.member(name, proc, size_hint=members[path][0], compress=compress):
+                    yield data
+            finally:
+                proc.close()
+        for data in zf.close():
+            yield data
+    finally:
+        for proc in started:
+            proc.close()